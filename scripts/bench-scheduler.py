@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+'''Benchmark the l10n scheduler against synthetic tree data.
+
+Runs against an in-memory sqlite database with the elmo models.
+
+Besides the startup time, this replays synthetic push streams through
+the scheduler, and reports changes and buildsets per second, database
+queries per change and the peak memory, to be used as a baseline for
+regressions:
+
+  en-US     pushes touching en-US files on the app branches
+  locales   a bulk merge pushing to all locale repositories
+  l10n.ini  edits of l10n.ini files, reloading the trees
+
+With --recovery, it also times the clean up of unfinished builds
+on master start.
+
+Use --vendor-local to benchmark another checkout, like the baseline
+in a git worktree, and compare the startup and reload costs.
+
+--json stores all results, to be used as the --baseline of later runs,
+which then print the ratios of their results to the baseline ones.
+'''
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import os.path
+import resource
+import site
+import time
+from twisted.application import service
+
+
+def setup_django():
+    from django.conf import settings
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=['life', 'pushes', 'mbdb', 'l10nstats'])
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def synthetic_trees(count, branches=10, dirs=5, locales=None):
+    '''Create count trees spread over a few en-US branches,
+    each with a few module dirs shared with the other trees on the branch.
+
+    Like the real l10n.ini graphs, each app l10n.ini includes the
+    toolkit l10n.ini, which is shared by all trees on the branch.
+    '''
+    from l10ninsp.scheduler import Tree
+    if locales is None:
+        locales = ['ab', 'cd', 'ef']
+    trees = []
+    for i in xrange(count):
+        branch = 'mozilla-%d' % (i % branches)
+        app = 'app%d' % i
+        t = Tree('tree%d' % i, 'http://localhost/', branch,
+                 'l10n-%d' % (i % branches), app + '/locales/l10n.ini')
+        t.addData(branch, app + '/locales/l10n.ini', [app])
+        t.addData(branch, 'toolkit/locales/l10n.ini',
+                  ['toolkit'] + ['shared/mod%d' % d for d in xrange(dirs)])
+        t.all_locales = app + '/locales/all-locales'
+        t.locales = locales[:]
+        trees.append(t)
+    return trees
+
+
+def synthetic_locales(count):
+    return ['x%d' % i for i in xrange(count)]
+
+
+def create_repositories(trees):
+    '''Create forests and repositories with an initial push
+    for all branches and locales of the trees.
+    '''
+    from life.models import Branch, Changeset, Forest, Push, Repository
+    default, _ = Branch.objects.get_or_create(name='default')
+    names = set()
+    for t in trees:
+        forest, _ = Forest.objects.get_or_create(name=t.branches['l10n'])
+        names.add((t.branches['en'], None))
+        for loc in t.locales:
+            names.add(('%s/%s' % (forest.name, loc), forest))
+    for name, forest in sorted(names):
+        repo, created = Repository.objects.get_or_create(
+            name=name, defaults={'url': 'http://localhost/' + name,
+                                 'forest': forest})
+        if not created:
+            continue
+        cs = Changeset.objects.create(
+            revision=hashlib.sha1(name).hexdigest(), branch=default)
+        repo.changesets.add(cs)
+        push = Push.objects.create(repository=repo, user='bench',
+                                   push_date=datetime.utcnow(),
+                                   push_id=1)
+        push.changesets.add(cs)
+
+
+def change(number, files, branch, locale=None):
+    from buildbot.changes.changes import Change
+    c = Change('bench', files, 'synthetic push', branch=branch,
+               when=time.time())
+    c.number = number
+    if locale is not None:
+        c.locale = locale
+    return c
+
+
+def en_US_storm(trees, pushes):
+    '''Pushes to the en-US branches, touching shared and app files.
+    '''
+    branches = sorted(set(t.branches['en'] for t in trees))
+    for i in xrange(pushes):
+        branch = branches[i % len(branches)]
+        files = ['shared/mod%d/locales/en-US/file%d.dtd' % (i % 5, i),
+                 'app%d/locales/en-US/file.properties' % i,
+                 'app%d/content/browser.js' % i]
+        yield change(i, files, branch)
+
+
+def locale_merge(trees, files):
+    '''A bulk merge, pushing files in all dirs to all locales.
+    '''
+    forests = {}
+    for t in trees:
+        forests.setdefault(t.branches['l10n'], set()).update(t.locales)
+    n = 0
+    for forest, locales in sorted(forests.iteritems()):
+        dirs = ['toolkit'] + ['shared/mod%d' % d for d in xrange(5)]
+        dirs += [t.branch2dirs[t.branches['en']][0] for t in trees
+                 if t.branches['l10n'] == forest]
+        for loc in sorted(locales):
+            paths = ['%s/file%d.dtd' % (dirs[i % len(dirs)], i)
+                     for i in xrange(files)]
+            yield change(n, paths, forest, locale=loc)
+            n += 1
+
+
+def l10nini_edits(trees, edits):
+    '''Edit the l10n.ini files of single trees and of toolkit.
+    '''
+    for i in xrange(edits):
+        t = trees[i % len(trees)]
+        if i % 4:
+            path = t.l10ninis[t.branches['en']][0]
+        else:
+            path = 'toolkit/locales/l10n.ini'
+        yield change(i, [path], t.branches['en'])
+
+
+SCENARIOS = (
+    ('en-US', en_US_storm),
+    ('locales', locale_merge),
+    ('l10n.ini', l10nini_edits),
+)
+
+
+class BenchMaster(service.MultiService):
+    '''Master that takes buildsets, without starting builds.
+
+    Tree builds are finished with reloaded tree data, compare buildsets
+    are finished as soon as we flush.
+    '''
+    def __init__(self, treebuilder):
+        service.MultiService.__init__(self)
+        self.treebuilder = treebuilder
+        self.trees = []
+        self.compares = []
+        self.count = 0
+
+    def submitBuildSet(self, bs):
+        if self.treebuilder in bs.builderNames:
+            self.trees.append(bs)
+        else:
+            self.compares.append(bs)
+            self.count += 1
+
+    def flush(self, scheduler, reload):
+        from buildbot.status.builder import SUCCESS
+
+        def finish(bs):
+            bs.status.setResults(SUCCESS)
+            bs.status.notifyFinishedWatchers()
+        while self.trees:
+            bs = self.trees.pop(0)
+            scheduler.addTree(reload(bs.getProperties()['tree']))
+            finish(bs)
+        if scheduler.dSubmitBuildsets is not None:
+            if scheduler.dSubmitBuildsets.active():
+                scheduler.dSubmitBuildsets.cancel()
+            scheduler.submitBuildsets()
+        while self.compares:
+            finish(self.compares.pop(0))
+        if (scheduler.dSubmitBuildsets is not None and
+                scheduler.dSubmitBuildsets.active()):
+            scheduler.dSubmitBuildsets.cancel()
+        scheduler.dSubmitBuildsets = None
+
+
+def bench_replay(trees, scenarios, size, batch):
+    '''Replay the push streams of the given scenarios against a
+    scheduler with the given trees, and flush every batch changes.
+    '''
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from l10ninsp import tips
+    from l10ninsp.scheduler import AppScheduler
+    revisions = {}
+
+    def reload(name):
+        # a tree build, adding a dir to the tree each time
+        t = copy_tree(s.trees[name])
+        revisions[name] = revisions.get(name, 0) + 1
+        en = t.branches['en']
+        t.addData(en, t.l10ninis[en][0],
+                  ['%s/extra%d' % (name, revisions[name])])
+        return t
+
+    results = []
+    print 'replay: scenario, changes, seconds, changes/s, buildsets, ' \
+        'buildsets/s, queries/change, peak MB'
+    for name, stream in SCENARIOS:
+        if name not in scenarios:
+            continue
+        tips.cache.clear()
+        master = BenchMaster('tree-builder')
+        s = AppScheduler('bench', ['compare'], None, 'tree-builder')
+        s.setServiceParent(master)
+        for t in trees:
+            s.addTree(copy_tree(t))
+        changes = list(stream(trees, size))
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            for i, c in enumerate(changes):
+                s.addChange(c)
+                if (i + 1) % batch == 0:
+                    master.flush(s, reload)
+            master.flush(s, reload)
+            elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        result = {
+            'scenario': name,
+            'changes': len(changes),
+            'seconds': elapsed,
+            'changes_per_second': len(changes) / elapsed,
+            'buildsets': master.count,
+            'buildsets_per_second': master.count / elapsed,
+            'queries_per_change': len(queries) / float(len(changes)),
+            'peak_mb': peak,
+        }
+        results.append(result)
+        print ('%(scenario)s, %(changes)d, %(seconds).3f, '
+               '%(changes_per_second).1f, %(buildsets)d, '
+               '%(buildsets_per_second).1f, %(queries_per_change).2f, '
+               '%(peak_mb).1f' % result)
+    return results
+
+
+def copy_tree(tree):
+    from l10ninsp.scheduler import Tree
+    return Tree.fromDict(json.loads(json.dumps(tree.asDict())))
+
+
+def bench_startup(sizes):
+    '''Time adding all trees to a fresh scheduler, like on master start,
+    and adding all of them again with an additional dir, like when
+    the trees reload.
+
+    Both should scale linearly with the number of trees, that is,
+    the time per tree should stay flat across the sizes.
+    '''
+    from l10ninsp.scheduler import AppScheduler
+    results = []
+    print 'startup: trees, seconds, ms per tree, ' \
+        'reload seconds, ms per tree'
+    for size in sizes:
+        trees = synthetic_trees(size)
+        s = AppScheduler('bench', ['compare'], None, 'tree-builder')
+        start = time.time()
+        for t in trees:
+            s.addTree(t)
+        startup = time.time() - start
+        reloaded = synthetic_trees(size)
+        for t in reloaded:
+            en = t.branches['en']
+            t.addData(en, t.l10ninis[en][0], [t.name + '/extra'])
+        start = time.time()
+        for t in reloaded:
+            s.addTree(t)
+        reload = time.time() - start
+        result = {
+            'trees': size,
+            'startup_seconds': startup,
+            'reload_seconds': reload,
+        }
+        results.append(result)
+        print '%d, %.3f, %.3f, %.3f, %.3f' % (
+            size, startup, startup * 1000 / size,
+            reload, reload * 1000 / size)
+    return results
+
+
+def create_debris(count):
+    '''Create count unfinished builds with a running step each,
+    for changes on the latest push, like after a master crash.
+    '''
+    from life.models import Push
+    from mbdb.models import (Build, Builder, Change, Master, SourceStamp,
+                             Step)
+    master, _ = Master.objects.get_or_create(name='bench')
+    builder, _ = Builder.objects.get_or_create(name='compare',
+                                               master=master)
+    push = Push.objects.order_by('-pk')[0]
+    now = datetime.utcnow()
+    for i in xrange(count):
+        change = Change.objects.create(number=i, who='bench',
+                                       comments='', when=now,
+                                       revision=push.tip.revision)
+        stamp = SourceStamp.objects.create()
+        stamp.changes.add(change)
+        build = Build.objects.create(builder=builder, buildnumber=i,
+                                     sourcestamp=stamp, starttime=now)
+        Step.objects.create(build=build, name='compare', starttime=now)
+
+
+def bench_recovery(sizes):
+    '''Time the crash recovery on master start.
+    '''
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from l10ninsp.changes import get_last_push_and_clean_up
+    results = []
+    print 'recovery: unfinished builds, seconds, queries'
+    for size in sizes:
+        create_debris(size)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            get_last_push_and_clean_up()
+            elapsed = time.time() - start
+        results.append({
+            'builds': size,
+            'seconds': elapsed,
+            'queries': len(queries),
+        })
+        print '%d, %.3f, %d' % (size, elapsed, len(queries))
+    return results
+
+
+# the results to compare with a baseline, by the key they're matched on
+BASELINE_METRICS = (
+    ('startup', 'trees', ('startup_seconds', 'reload_seconds')),
+    ('replay', 'scenario', ('changes_per_second', 'buildsets_per_second',
+                            'queries_per_change', 'peak_mb')),
+    ('recovery', 'builds', ('seconds', 'queries')),
+)
+
+
+def compare_baseline(baseline, results):
+    '''Print the ratios of the results to the ones of the baseline,
+    for the sizes and scenarios in both.
+    '''
+    print 'baseline: section, size or scenario, metric, baseline, now, ratio'
+    for section, key, metrics in BASELINE_METRICS:
+        old = dict((r[key], r) for r in baseline.get(section, []))
+        for result in results[section]:
+            if result[key] not in old:
+                continue
+            for metric in metrics:
+                before, after = old[result[key]][metric], result[metric]
+                ratio = after / float(before) if before else float('nan')
+                print '%s, %s, %s, %.3f, %.3f, %.2f' % (
+                    section, result[key], metric, before, after, ratio)
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[100, 200, 400, 800, 1600],
+                   help='tree counts to time the startup and reload for')
+    p.add_argument('--trees', type=int, default=50,
+                   help='number of trees to replay pushes against')
+    p.add_argument('--locales', type=int, default=100,
+                   help='number of locales per tree')
+    p.add_argument('--pushes', type=int, default=200,
+                   help='number of pushes per scenario, or files per '
+                   'locale for bulk merges')
+    p.add_argument('--batch', type=int, default=20,
+                   help='number of changes between submitting buildsets')
+    p.add_argument('--scenario', nargs='*', dest='scenarios',
+                   choices=[_n for _n, _s in SCENARIOS],
+                   default=[_n for _n, _s in SCENARIOS],
+                   help='push streams to replay, none to just time the '
+                   'startup and reload')
+    p.add_argument('--json', help='write the results to this file')
+    p.add_argument('--baseline',
+                   help='compare the results to the ones in this file')
+    p.add_argument('--recovery', type=int, nargs='+', default=[],
+                   help='unfinished build counts to time the crash '
+                   'recovery for')
+    p.add_argument('--vendor-local', default=os.path.join(
+        os.path.dirname(__file__), '..', 'vendor-local'),
+        help='vendor-local directory of the checkout to benchmark')
+    args = p.parse_args()
+
+    site.addsitedir(args.vendor_local)
+    setup_django()
+    results = {
+        'startup': bench_startup(args.sizes),
+        'replay': [],
+        'recovery': [],
+    }
+    if args.scenarios or args.recovery:
+        trees = synthetic_trees(args.trees,
+                                locales=synthetic_locales(args.locales))
+        create_repositories(trees)
+        results['replay'] = bench_replay(trees, args.scenarios, args.pushes,
+                                         args.batch)
+        results['recovery'] = bench_recovery(args.recovery)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_baseline(json.load(f), results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
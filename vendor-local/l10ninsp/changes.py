@@ -3,61 +3,238 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from calendar import timegm
+from collections import defaultdict, deque
+import os
+import socket
+import time
 
 from twisted.python import log
-from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
 
 from buildbot.status.builder import EXCEPTION
 from buildbot.changes import base, changes
 
+import tips
 
-def createChangeSource(pollInterval=3*60):
+
+def createChangeSource(pollInterval=3*60, notifySocket=None,
+                       collapseBacklog=False):
     from life.models import Push, Branch, File
     from django.db import transaction
+    from django.db.models import Max, Q
 
     class MBDBChangeSource(base.ChangeSource):
         debug = True
 
-        def __init__(self,  latest_push, pollInterval=30, branch='default'):
+        def __init__(self,  latest_push, pollInterval=30, branch='default',
+                     pageSize=100, maxPushes=1000, minInterval=1,
+                     notifySocket=None, collapseBacklog=False):
+            '''Create the change source.
+
+            pageSize is the number of pushes to load at once,
+            maxPushes limits the pushes handled in one poll, the
+            next poll continues with the rest.
+            Polls happen every minInterval seconds while there are new
+            pushes, and back off to pollInterval when idle.
+            notifySocket is the path of a UNIX socket to listen on for
+            push notifications, which trigger a poll right away.
+            If collapseBacklog is True, the pushes up to the latest one
+            at startup are submitted as one change per repository,
+            with all files and the latest revision.
+            '''
             self.pollInterval = pollInterval
+            self.interval = PollInterval(minInterval, pollInterval)
             self.latest = latest_push
+            self.pageSize = pageSize
+            self.maxPushes = maxPushes
+            self.notifySocket = notifySocket
+            self.listener = None
+            self.dPoll = None
             self.branch, created = \
                 Branch.objects.get_or_create(name=branch)
+            # push id to catch up to, and the folded pushes and files
+            # per repository, in backlog collapse mode
+            self.collapseBacklog = collapseBacklog
+            self.catchUpTo = None
+            self.backlog = {}
 
         def startService(self):
-            self.loop = LoopingCall(self.poll)
             base.ChangeSource.startService(self)
-            reactor.callLater(0, self.loop.start, self.pollInterval)
+            if self.collapseBacklog:
+                # the head of the queue when we start, not when the
+                # config got loaded
+                head = Push.objects.aggregate(Max('id'))['id__max']
+                if head is not None and head > self.latest:
+                    log.msg('collapsing backlog of pushes %d to %d' %
+                            (self.latest + 1, head))
+                    self.catchUpTo = head
+            self.dPoll = reactor.callLater(0, self.poll)
+            if self.notifySocket is not None:
+                self.listener = reactor.listenUNIX(
+                    self.notifySocket, PushNotificationFactory(self.notify),
+                    wantPID=True)
 
         def stopService(self):
-            self.loop.stop()
-            return base.ChangeSource.stopService(self)
+            if self.dPoll is not None and self.dPoll.active():
+                self.dPoll.cancel()
+            self.dPoll = None
+            d = defer.maybeDeferred(base.ChangeSource.stopService, self)
+            if self.listener is not None:
+                d.addCallback(lambda _, listener=self.listener:
+                              listener.stopListening())
+                self.listener = None
+            return d
+
+        def notify(self):
+            '''A push got notified, poll now.
+            '''
+            if self.dPoll is not None and self.dPoll.active():
+                self.dPoll.reset(0)
 
         def poll(self):
-            '''Check for new pushes.
+            '''Check for new pushes, and schedule the next poll.
             '''
             import django.db.utils
+            self.dPoll = None
+            handled = 0
             try:
-                with transaction.atomic():
-                    new_pushes = (
-                        Push.objects
-                        .filter(pk__gt=self.latest)
-                        .order_by('pk'))
-                    if self.debug:
-                        log.msg('mbdb changesource found %d pushes after %d' %
-                                (new_pushes.count(), self.latest))
-                    push = None
-                    for push in new_pushes:
-                        self.submitChangesForPush(push)
-                    if push is not None:
-                        self.latest = push.id
+                while handled < self.maxPushes:
+                    count = self.pollPage(
+                        min(self.pageSize, self.maxPushes - handled))
+                    handled += count
+                    if count < self.pageSize:
+                        break
             except django.db.utils.OperationalError:
                 from django import db
                 db.connection.close()
                 log.msg('Django database OperationalError caught')
+            if self.debug:
+                log.msg('mbdb changesource handled %d pushes, up to %d' %
+                        (handled, self.latest))
+            if self.running:
+                delay = self.interval.next(handled > 0)
+                self.dPoll = reactor.callLater(delay, self.poll)
+
+        def pollPage(self, limit):
+            '''Submit changes for the next limit pushes.
+
+            Loads the pushes with their repositories and changesets,
+            and the files of all pushes in one query. Pushes to
+            repositories that no scheduler is interested in are skipped,
+            and their tips dropped from the tip cache.
+            Returns the number of pushes, including skipped ones.
+            '''
+            with transaction.atomic():
+                # the window of pushes, including the ones nobody needs
+                window = list(
+                    Push.objects
+                    .filter(pk__gt=self.latest)
+                    .order_by('pk')
+                    .values_list('pk', 'repository__name',
+                                 'repository__forest__name')[:limit])
+                if not window:
+                    if self.catchUpTo is not None:
+                        # pushes got removed, we're at the head anyway
+                        self.submitBacklog()
+                    return 0
+                new_pushes = Push.objects.filter(pk__gt=self.latest,
+                                                 pk__lte=window[-1][0])
+                interests = self.getInterests()
+                if interests is not None:
+                    branches, forests = interests
+                    new_pushes = new_pushes.filter(
+                        Q(repository__forest__name__in=forests) |
+                        Q(repository__forest__isnull=True,
+                          repository__name__in=branches))
+                    # we don't see the tips of the skipped pushes, the
+                    # cache would be stale once a tree needs them again
+                    for _pk, name, forest in window:
+                        if forest is not None:
+                            skipped = forest not in forests
+                        else:
+                            skipped = name not in branches
+                        if skipped:
+                            tips.cache.invalidate(name)
+                for push, files in self.loadPushes(new_pushes, limit):
+                    if self.catchUpTo is not None:
+                        self.foldPush(push, files)
+                    else:
+                        self.submitChangesForPush(push, files)
+                # move past the pushes we filtered, too
+                self.latest = window[-1][0]
+                if (self.catchUpTo is not None and
+                        self.latest >= self.catchUpTo):
+                    self.submitBacklog()
+            return len(window)
+
+        def foldPush(self, push, files):
+            '''Add a push to the backlog, keeping only the latest push
+            per repository, and all files.
+            '''
+            _p, _files = self.backlog.get(push.repository_id,
+                                          (None, set()))
+            _files.update(files)
+            self.backlog[push.repository_id] = (push, _files)
+
+        def submitBacklog(self):
+            '''Submit one change per repository in the backlog, and
+            go back to a change per push.
+            '''
+            log.msg('caught up to push %d, submitting %d changes' %
+                    (self.latest, len(self.backlog)))
+            backlog = sorted(self.backlog.itervalues(),
+                             key=lambda (push, files): push.id)
+            self.backlog = {}
+            self.catchUpTo = None
+            for push, files in backlog:
+                self.submitChangesForPush(push, sorted(files))
 
-        def submitChangesForPush(self, push):
+        def loadPushes(self, pushes, limit):
+            '''Load the first limit pushes of the given queryset, in
+            push id order, with their repositories and changesets.
+
+            Returns a list of tuples of pushes and their file paths.
+            '''
+            pushes = list(pushes
+                          .order_by('pk')
+                          .select_related('repository__forest')
+                          .prefetch_related('changesets')[:limit])
+            files = defaultdict(list)
+            for push_id, path in (
+                    File.objects
+                    .filter(changeset__pushes__in=pushes)
+                    .order_by()
+                    .values_list('changeset__pushes', 'path')
+                    .distinct()):
+                files[push_id].append(path)
+            return [(push, files[push.id]) for push in pushes]
+
+        def getInterests(self):
+            '''Get the en-US branches and l10n forests that the schedulers
+            need changes for, as a tuple of sets.
+
+            Returns None if any scheduler needs all changes.
+            '''
+            branches, forests = set(), set()
+            for scheduler in self.parent.parent.allSchedulers():
+                getInterests = getattr(scheduler, 'getInterests', None)
+                if getInterests is None:
+                    return None
+                interests = getInterests()
+                if interests is None:
+                    return None
+                branches.update(interests[0])
+                forests.update(interests[1])
+            return branches, forests
+
+        def submitChangesForPush(self, push, files=None):
+            '''Submit a change for push.
+
+            files are the paths of the files in the push, if they're
+            known already.
+            '''
             if self.debug:
                 log.msg('submitChangesForPush called')
             repo = push.repository
@@ -66,17 +243,26 @@ def createChangeSource(pollInterval=3*60):
                 locale = repo.name[len(branch) + 1:].encode('utf-8')
             else:
                 branch = repo.name.encode('utf-8')
-            files = [f.encode('utf-8') for f in
-                     File.objects
+            if files is None:
+                files = (File.objects
                          .filter(changeset__pushes=push)
                          .distinct()
-                         .values_list('path', flat=True)]
+                         .values_list('path', flat=True))
+            files = [f.encode('utf-8') for f in files]
             when = timegm(push.push_date.utctimetuple()) + \
                 push.push_date.microsecond/1000.0/1000
+            # like push.tip, but using prefetched changesets
+            tip = max(push.changesets.all(), key=lambda cs: cs.pk)
+            if tip.branch_id == self.branch.id:
+                tips.cache.update(repo.name, push.id, push.push_date,
+                                  str(tip.revision))
+            else:
+                # the default head is somewhere in the push, or earlier
+                tips.cache.invalidate(repo.name)
             c = changes.Change(who=push.user.encode('utf-8'),
                                files=files,
-                               revision=push.tip.revision.encode('utf-8'),
-                               comments=push.tip.description.encode('utf-8'),
+                               revision=tip.revision.encode('utf-8'),
+                               comments=tip.description.encode('utf-8'),
                                when=when,
                                branch=branch)
             if repo.forest is not None:
@@ -85,7 +271,24 @@ def createChangeSource(pollInterval=3*60):
             self.parent.addChange(c)
 
         def replay(self, builder,
-                   startPush=None, startTime=None, endTime=None):
+                   startPush=None, startTime=None, endTime=None,
+                   inflight=8, checkpoint=None):
+            '''Submit changes for past pushes, in push id order.
+
+            This used to go by push_date. Pushes are stored in the order
+            they land, so the two orders only differ for pushes with odd
+            dates. Paging by id doesn't skip or repeat pushes with the
+            same date, though.
+            New pushes are submitted while there are less than inflight
+            builds pending or running on builder, or pending in the
+            schedulers, to keep all slaves busy.
+            If checkpoint is a path, the id of the last push of each
+            submitted page is stored there, and a replay without
+            startPush resumes after it.
+
+            Returns a Deferred that fires with the number of pushes
+            when all are submitted.
+            '''
             bm = self.parent.parent.botmaster
             qd = {}
             if startTime is not None:
@@ -94,26 +297,58 @@ def createChangeSource(pollInterval=3*60):
                 qd['push_date__lte'] = endTime
             if startPush is not None:
                 qd['id__gte'] = startPush
-            q = Push.objects.filter(**qd).order_by('push_date')
-            i = q.iterator()
-            if self.debug:
-                log.msg('replay called for %d pushes' % q.count())
+            elif checkpoint is not None and os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    qd['id__gt'] = int(f.read())
+            q = Push.objects.filter(**qd)
+            total = q.count()
+            log.msg('replay called for %d pushes' % total)
+            progress = {'latest': 0, 'count': 0, 'start': time.time()}
+            page = deque()
+            done = defer.Deferred()
 
-            def next(_cb):
-                try:
-                    p = i.next()
-                except StopIteration:
-                    log.msg("done iterating")
-                    return
-                self.submitChangesForPush(p)
+            def busy():
+                b = bm.builders[builder]
+                count = len(b.buildable) + len(b.building)
+                for scheduler in self.parent.parent.allSchedulers():
+                    count += len(getattr(scheduler, 'pendings', ()))
+                return count
 
-                def stumble():
-                    bm.waitUntilBuilderIdle(builder).addCallback(_cb, _cb)
-                reactor.callLater(.5, stumble)
+            def report():
+                elapsed = time.time() - progress['start']
+                log.msg('replayed %d of %d pushes, up to %d, '
+                        '%.2f pushes/s' %
+                        (progress['count'], total, progress['latest'],
+                         progress['count'] / max(elapsed, 1)))
 
-            def cb(res, _cb):
-                reactor.callLater(.5, next, _cb)
-            next(cb)
+            def step():
+                try:
+                    while busy() < inflight:
+                        if not page:
+                            page.extend(self.loadPushes(
+                                q.filter(pk__gt=progress['latest']),
+                                self.pageSize))
+                            if not page:
+                                report()
+                                log.msg('done replaying')
+                                done.callback(progress['count'])
+                                return
+                        push, files = page.popleft()
+                        self.submitChangesForPush(push, files)
+                        progress['latest'] = push.id
+                        progress['count'] += 1
+                        if checkpoint is not None and not page:
+                            with open(checkpoint + '.tmp', 'w') as f:
+                                f.write(str(push.id))
+                            os.rename(checkpoint + '.tmp', checkpoint)
+                        if progress['count'] % self.pageSize == 0:
+                            report()
+                    reactor.callLater(1, step)
+                except Exception:
+                    log.msg('replay failed after push %d' % progress['latest'])
+                    done.errback()
+            step()
+            return done
 
         def describe(self):
             return str(self)
@@ -122,10 +357,60 @@ def createChangeSource(pollInterval=3*60):
             return "MBDBChangeSource"
 
     latest_push = get_last_push_and_clean_up()
-    c = MBDBChangeSource(latest_push, pollInterval)
+    c = MBDBChangeSource(latest_push, pollInterval,
+                         notifySocket=notifySocket,
+                         collapseBacklog=collapseBacklog)
     return c
 
 
+class PollInterval(object):
+    '''Adaptive poll interval, short while there's activity,
+    and backing off to maximum when idle.
+    '''
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.current = minimum
+
+    def next(self, active):
+        '''Get the seconds to the next poll, given if the last one
+        found something.
+        '''
+        if active:
+            self.current = self.minimum
+        else:
+            self.current = min(self.current * 2, self.maximum)
+        return self.current
+
+
+class PushNotification(LineReceiver):
+    def lineReceived(self, line):
+        self.factory.callback()
+
+
+class PushNotificationFactory(ServerFactory):
+    '''Listen for push notifications, each line calls callback.
+    '''
+    protocol = PushNotification
+
+    def __init__(self, callback):
+        self.callback = callback
+
+
+def notifyPushes(path, message='push'):
+    '''Tell the change source listening on the UNIX socket at path
+    that there are new pushes.
+
+    This is used by the code that stores the pushes, and blocks.
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(message + '\r\n')
+    finally:
+        s.close()
+
+
 def get_last_push_and_clean_up():
     '''Find the starting point for the push changesource.
 
@@ -135,8 +420,10 @@ def get_last_push_and_clean_up():
     changes, and clean up the mbdb.
     '''
     from life.models import Changeset, Push
-    from mbdb.models import Build, BuildRequest, Change
-    from django.db.models import F, Max, Min, Q
+    from mbdb.models import Build, BuildRequest, Change, Step
+    from django.db.models import (Case, DateTimeField, F, IntegerField,
+                                  Max, Min, OuterRef, Q, Subquery, When)
+    from django.db.models.functions import Coalesce, Greatest
     # Check for debris of a bad shut-down
     # Indications:
     # - Pending builds (build requests w/out builds, but with changes)
@@ -153,9 +440,11 @@ def get_last_push_and_clean_up():
         )
     )
     pending_query = Q(stamps__requests__in=pending_requests)
-    unfinished_builds = (
+    # load the ids, MySQL can't update builds with a subquery on builds
+    unfinished_builds = list(
         Build.objects
         .filter(endtime__isnull=True)
+        .values_list('id', flat=True)
     )
     unfinished_query = Q(stamps__builds__in=unfinished_builds)
     revs.extend(
@@ -173,18 +462,30 @@ def get_last_push_and_clean_up():
         pending_requests.delete()
         # set end time on builds to last step endtime or starttime
         # result of build and last step to EXCEPTION
-        for build in unfinished_builds:
-            (
-                build.steps
-                .filter(endtime__isnull=True)
-                .update(endtime=F('starttime'), result=EXCEPTION)
-            )
-            build.endtime = max(
-                list(build.steps.values_list('endtime', flat=True)) +
-                [build.starttime]
-            )
-            build.result = EXCEPTION
-            build.save()
+        (
+            Step.objects
+            .filter(build__in=unfinished_builds, endtime__isnull=True)
+            .update(endtime=F('starttime'), result=EXCEPTION)
+        )
+        last_step = (
+            Step.objects
+            .filter(build=OuterRef('pk'))
+            .order_by()
+            .values('build')
+            .annotate(last=Max('endtime'))
+            .values('last')
+        )
+        (
+            Build.objects
+            .filter(id__in=unfinished_builds)
+            .update(
+                endtime=Greatest(
+                    Coalesce(Subquery(last_step,
+                                      output_field=DateTimeField()),
+                             F('starttime')),
+                    F('starttime')),
+                result=EXCEPTION)
+        )
         # now that we cleaned up the debris, let's see where we want to start
         changesets = (
             Changeset.objects
@@ -201,18 +502,37 @@ def get_last_push_and_clean_up():
             return last_push - 1
 
     # OK, so either there wasn't any debris, or there was no push on it
-    # Find the last push with a run, in id ordering, not push_date ordering.
-    for p in Push.objects.order_by('-pk').prefetch_related('changesets')[:100]:
-        if p.tip.run_set.exists():
-            log.msg("restarting after a push with run: %d" % p.id)
-            return p.id
+    # Find the last push with a run, in id ordering, not push_date ordering,
+    # within the last 100 pushes. The tip is the latest changeset, and
+    # it has a run if it's the latest changeset with a run, too.
+    # Load the ids first, so that only those pushes are aggregated,
+    # MySQL can't limit a subquery in IN.
+    recent_ids = list(
+        Push.objects
+        .order_by('-pk')
+        .values_list('id', flat=True)[:100]
+    )
+    recent = list(
+        Push.objects
+        .filter(id__in=recent_ids)
+        .order_by('-pk')
+        .annotate(
+            tip=Max('changesets__id'),
+            run_tip=Max(Case(When(changesets__run__isnull=False,
+                                  then=F('changesets__id')),
+                             output_field=IntegerField())))
+        .values_list('id', 'tip', 'run_tip')
+    )
+    for push_id, tip, run_tip in recent:
+        if tip is not None and tip == run_tip:
+            log.msg("restarting after a push with run: %d" % push_id)
+            return push_id
 
     # We don't have recent builds, just use the last push
-    try:
-        p = Push.objects.order_by('-pk')[0]
-        log.msg("restarting after the last push: %d" % p.id)
-        return p.id
-    except IndexError:
-        # new data
-        log.msg("new data, starting poller with 0")
-        return 0
+    if recent:
+        latest = recent[0][0]
+        log.msg("restarting after the last push: %d" % latest)
+        return latest
+    # new data
+    log.msg("new data, starting poller with 0")
+    return 0
@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Shared loading of l10n.ini and all-locales files over HTTP.
+
+Responses are cached on disk per URL, and revalidated with ETag and
+Last-Modified, so that repeated tree builds and master restarts mostly
+cost 304s. Concurrent requests for the same URL share one download.
+The least recently used responses are removed beyond maxEntries.
+'''
+
+from twisted.internet import defer, threads
+from twisted.python import failure, log
+
+import hashlib
+import json
+import markus
+import os
+import urllib2
+
+
+metrics = markus.get_metrics('elmo-builds')
+
+
+class PageCache(object):
+    def __init__(self, cachedir=None, maxEntries=2000):
+        # directory to store responses in, None to not cache
+        self.cachedir = cachedir
+        # number of responses to keep, the least recently used ones
+        # get removed. URLs contain revisions, and don't get reused
+        self.maxEntries = maxEntries
+        self.stored = 0
+        # url -> deferreds waiting for the running request
+        self.inflight = {}
+
+    def getPage(self, url, agent=None, timeout=0):
+        '''Load url, like twisted.web.client.getPage.
+
+        The request is done with urllib2 in a thread, which verifies
+        the certificates of https URLs.
+        '''
+        if url in self.inflight:
+            metrics.incr('fetch_coalesced')
+            d = defer.Deferred()
+            self.inflight[url].append(d)
+            return d
+        self.inflight[url] = []
+        d = defer.maybeDeferred(threads.deferToThread,
+                                self.fetch, url, agent, timeout)
+        d.addCallbacks(self.onPage, self.onNoPage)
+        d.addBoth(self.onDone, url)
+        return d
+
+    def fetch(self, url, agent, timeout):
+        '''Load url, revalidating the cached response, if any.
+
+        Runs in a thread. Returns the page, and if it's from the cache.
+        '''
+        entry = self.load(url)
+        request = urllib2.Request(url)
+        if agent is not None:
+            request.add_header('User-Agent', agent)
+        if entry is not None:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', str(entry['etag']))
+            if entry.get('last-modified'):
+                request.add_header('If-Modified-Since',
+                                   str(entry['last-modified']))
+        kwargs = {}
+        if timeout:
+            kwargs['timeout'] = timeout
+        try:
+            response = urllib2.urlopen(request, **kwargs)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry is not None:
+                self.touch(url)
+                return entry['body'], True
+            raise
+        try:
+            page = response.read()
+            info = response.info()
+        finally:
+            response.close()
+        validators = {}
+        for header in ('etag', 'last-modified'):
+            if info.getheader(header):
+                validators[header] = info.getheader(header)
+        if validators:
+            self.store(url, validators, page)
+        return page, False
+
+    def onPage(self, result):
+        page, cached = result
+        if cached:
+            metrics.incr('fetch_hit')
+            metrics.incr('fetch_bytes_cached', len(page))
+        else:
+            metrics.incr('fetch_miss')
+            metrics.incr('fetch_bytes', len(page))
+        return page
+
+    def onNoPage(self, reason):
+        metrics.incr('fetch_error')
+        return reason
+
+    def onDone(self, result, url):
+        # pass our result on to the requests that joined ours
+        for d in self.inflight.pop(url):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def path(self, url):
+        return os.path.join(self.cachedir, hashlib.sha1(url).hexdigest())
+
+    def load(self, url):
+        '''Get the cached response for url, or None.
+        '''
+        if self.cachedir is None:
+            return None
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                entry = json.load(f)
+            with open(path, 'rb') as f:
+                entry['body'] = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def store(self, url, validators, page):
+        if self.cachedir is None:
+            return
+        path = self.path(url)
+        entry = dict(validators, url=url)
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # drop the old metadata, and write it after the body,
+            # it marks the entry as valid
+            if os.path.exists(path + '.json'):
+                os.remove(path + '.json')
+            with open(path + '.tmp', 'wb') as f:
+                f.write(page)
+            os.rename(path + '.tmp', path)
+            with open(path + '.json.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.rename(path + '.json.tmp', path + '.json')
+        except (IOError, OSError), e:
+            log.msg('failed to cache %s: %s' % (url, str(e)))
+            return
+        self.stored += 1
+        if self.maxEntries is not None and self.stored % 100 == 0:
+            self.prune()
+
+    def touch(self, url):
+        '''Mark the cached response for url as recently used.
+        '''
+        try:
+            os.utime(self.path(url) + '.json', None)
+        except OSError:
+            pass
+
+    def prune(self):
+        '''Remove the least recently used responses beyond maxEntries.
+        '''
+        try:
+            entries = []
+            for name in os.listdir(self.cachedir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.cachedir, name[:-len('.json')])
+                entries.append((os.path.getmtime(path + '.json'), path))
+        except OSError, e:
+            log.msg('failed to list %s: %s' % (self.cachedir, str(e)))
+            return
+        entries.sort(reverse=True)
+        for mtime, path in entries[self.maxEntries:]:
+            for p in (path + '.json', path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+cache = PageCache()
@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Read files like l10n.ini and all-locales from the local clones
+of the repositories, at a given revision.
+
+Falls back to loading the file over HTTP if there's no local clone,
+or if the clone doesn't have the revision yet.
+'''
+
+from twisted.internet import utils
+from twisted.python import log
+
+import markus
+import os
+
+from life.models import Repository
+
+import httpcache
+
+
+metrics = markus.get_metrics('elmo-builds')
+
+
+class LocalFiles(object):
+    def __init__(self, base=None):
+        # directory with the local clones, like settings.REPOSITORY_BASE,
+        # None to always load over HTTP
+        self.base = base
+        # repository names to their path relative to base
+        self.paths = {}
+
+    def relative_path(self, branch):
+        '''The path of the clone of the repository named branch,
+        relative to base.
+        '''
+        if branch not in self.paths:
+            try:
+                repo = Repository.objects.get(name=branch)
+            except Repository.DoesNotExist:
+                # not known yet, try again next time
+                return branch
+            self.paths[branch] = repo.relative_path()
+        return self.paths[branch]
+
+    def clone(self, branch):
+        '''Path to the local clone of branch, or None.
+        '''
+        if self.base is None:
+            return None
+        path = os.path.join(self.base, self.relative_path(branch))
+        if not os.path.isdir(os.path.join(path, '.hg')):
+            return None
+        return path
+
+    def getFile(self, repo, branch, rev, path, agent=None, timeout=0):
+        '''Get the contents of path at rev in branch.
+
+        repo and branch make up the URL to load the file from,
+        if we can't read it locally.
+        '''
+        url = repo + '/' + branch + '/raw-file/' + rev + '/' + path
+        clone = self.clone(branch)
+        if clone is None:
+            return self.fromHTTP(None, url, agent, timeout)
+        d = utils.getProcessOutputAndValue('hg', ['cat', '-r', rev, path],
+                                           env=os.environ, path=clone)
+        d.addCallback(self.onCat, clone, rev, path)
+        d.addErrback(self.fromHTTP, url, agent, timeout)
+        return d
+
+    def onCat(self, result, clone, rev, path):
+        out, err, code = result
+        if code != 0:
+            raise IOError('hg cat -r %s %s in %s failed: %s' %
+                          (rev, path, clone, err.strip()))
+        metrics.incr('files_local')
+        return out
+
+    def fromHTTP(self, failure, url, agent, timeout):
+        if failure is not None:
+            log.msg('falling back to %s: %s' %
+                    (url, failure.getErrorMessage()))
+        metrics.incr('files_http')
+        return httpcache.cache.getPage(url, agent=agent, timeout=timeout)
+
+
+files = LocalFiles()
@@ -8,9 +8,115 @@ from buildbot.process.properties import WithProperties
 
 from twisted.python import log
 
+import markus
+import time
+import weakref
+
+from l10ninsp.scheduler import PRIORITIES
 from l10ninsp.steps import InspectLocale
 
 
+metrics = markus.get_metrics('elmo-builds')
+
+# seconds of waiting after which a request moves up one priority class
+AGING = 15 * 60
+# maximum number of locales compared in one build
+BATCH_LOCALES = 20
+
+# requests picked for a build, to the locales and the revisions of
+# everything but the localizations of the requests merged into them
+_batches = weakref.WeakKeyDictionary()
+
+
+def nextBuild(builder, requests):
+    '''Pick the next request to build by the priority set by the
+    AppScheduler.
+
+    Requests age, so that low priority requests don't starve
+    behind a steady stream of high priority ones.
+    '''
+    now = time.time()
+
+    def rank(req):
+        try:
+            level = PRIORITIES.index(req.properties.getProperty('priority'))
+        except ValueError:
+            level = len(PRIORITIES)
+        submitted = req.getSubmitTime() or now
+        return (level - (now - submitted) / AGING, submitted)
+    return min(requests, key=rank)
+
+
+def mergeRequests(builder, req1, req2):
+    '''Merge requests for the same tree and locale.
+
+    Queued compares of a tree and locale are obsoleted by the newest one,
+    Factory.newBuild makes sure that its revisions are used, with the
+    changes of all merged requests.
+    Compares of other locales of the same tree at the same en-US
+    revisions are batched into one build, up to BATCH_LOCALES.
+    Requests without a locale, like tree builds, merge if all
+    properties are the same.
+    '''
+    if not req1.canBeMergedWith(req2):
+        return False
+    props1, props2 = req1.properties, req2.properties
+    if props1.getProperty('locale') is None:
+        return props1 == props2
+    if props1.getProperty('tree') != props2.getProperty('tree'):
+        return False
+    if not canBatch(req1, req2):
+        return False
+    if props1.getProperty('locale') != props2.getProperty('locale'):
+        metrics.incr('requests_batched', tags=[builder.name])
+    else:
+        metrics.incr('requests_merged', tags=[builder.name])
+    return True
+
+
+def sourceRevisions(props):
+    '''Get the revisions of everything but the localization, as
+    compared for the request with the given properties.
+    '''
+    revisions = props.getProperty('revisions')
+    rv = [props.getProperty('inipath'), props.getProperty('l10nbase')]
+    if revisions is not None:
+        rv.append(tuple(revisions))
+        for mod in revisions:
+            if mod == 'l10n':
+                continue
+            rv += [props.getProperty('%s_branch' % mod),
+                   props.getProperty('%s_revision' % mod)]
+    return tuple(rv)
+
+
+def canBatch(req1, req2):
+    '''Check if req2 can go into the build for req1.
+
+    Newer requests for the locale of a single-locale build always can.
+    Once a build batches locales, all its requests need to compare the
+    same revisions of everything but the localizations, and have
+    an l10n revision. Batches take up to BATCH_LOCALES locales.
+    '''
+    props1, props2 = req1.properties, req2.properties
+    batch = _batches.get(req1)
+    if batch is None:
+        batch = _batches[req1] = (set([props1.getProperty('locale')]),
+                                  set([sourceRevisions(props1)]))
+    locales, sources = batch
+    locale, source = props2.getProperty('locale'), sourceRevisions(props2)
+    if len(locales) > 1 or locale not in locales:
+        if sources != set([source]):
+            return False
+        if 'l10n' not in (props2.getProperty('revisions') or []):
+            return False
+        if locale not in locales and len(locales) >= BATCH_LOCALES:
+            return False
+    locales.add(locale)
+    sources.add(source)
+    return True
+
+
 class Factory(factory.BuildFactory):
     useProgress = False
 
@@ -21,13 +127,40 @@ class Factory(factory.BuildFactory):
         self.mastername = mastername
 
     def newBuild(self, requests):
-        steps = self.createSteps(requests[-1])
+        # the properties of the last request win, make that the newest
+        # one, with the latest revisions
+        requests = sorted(requests, key=lambda r: r.getSubmitTime())
+        for req in requests:
+            _batches.pop(req, None)
+        steps = self.createSteps(requests[-1], self.batchLocales(requests))
         b = self.buildClass(requests)
+        # merged requests may share changes, only keep them once
+        changes = []
+        for c in b.source.changes:
+            if c not in changes:
+                changes.append(c)
+        b.source.changes = tuple(changes)
         b.useProgress = self.useProgress
         b.setStepFactories(steps)
         return b
 
-    def createSteps(self, request):
+    def batchLocales(self, requests):
+        '''Get the properties of the newest request per locale,
+        sorted by locale, if the requests are for more than one locale.
+        '''
+        newest = {}
+        for req in requests:
+            newest[req.properties.getProperty('locale')] = req.properties
+        if len(newest) < 2:
+            return None
+        return [props for locale, props in sorted(newest.iteritems())]
+
+    def createSteps(self, request, batch=None):
+        '''Create the steps for request.
+
+        batch is a list of properties of requests for multiple locales
+        to compare in this build, or None.
+        '''
         revs = request.properties.getProperty('revisions')
         if revs is None:
             revs = ['en', 'l10n']
@@ -65,10 +198,40 @@ class Factory(factory.BuildFactory):
                                                       '/%%(%s_branch)s' % mod),
                             'haltOnFailure': True})
             for mod in revs)
+        locales = None
+        if batch is not None:
+            # the other locales, the build properties cover request
+            locales = []
+            for props in batch:
+                locales.append((props['locale'], props['l10n_revision'],
+                                props.getProperty('srctime')))
+                if props['locale'] == request.properties['locale']:
+                    continue
+                branch = props['l10n_branch']
+                if self.hg_shares is not None:
+                    shareSteps += (
+                        (ShellCommand, {
+                            'command': ['mkdir', '-p', branch],
+                            'workdir': hg_workdir
+                        }),
+                        (ShellCommand, {
+                            'command': hg + ['share', '-U',
+                                             self.base + '/' + branch,
+                                             branch],
+                            'workdir': hg_workdir,
+                            'flunkOnFailure': False
+                        }))
+                sourceSteps += (
+                    (ShellCommand, {'command':
+                                    hg + ['update', '-C', '-r',
+                                          props['l10n_revision']],
+                                    'workdir': hg_workdir + '/' + branch,
+                                    'haltOnFailure': True}),)
         redirects = {}
-        for key, value, src in request.properties.asList():
-            if key.startswith('local_'):
-                redirects[key[len('local_'):]] = value
+        for props in batch or [request.properties]:
+            for key, value, src in props.asList():
+                if key.startswith('local_'):
+                    redirects[key[len('local_'):]] = value
         inspectSteps = (
             (InspectLocale, {
                     'master': self.mastername,
@@ -78,5 +241,6 @@ class Factory(factory.BuildFactory):
                     'redirects': redirects,
                     'locale': WithProperties('%(locale)s'),
                     'tree': tree,
+                    'locales': locales,
                     }),)
         return shareSteps + sourceSteps + inspectSteps
@@ -8,26 +8,63 @@ from buildbot.sourcestamp import SourceStamp
 from buildbot import buildset
 from buildbot.process import properties
 from buildbot.util import ComparableMixin
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
-import os.path
-from ConfigParser import ConfigParser
-import urllib2
+import json
+import markus
+import os
+import time
+from ConfigParser import ConfigParser, Error as ConfigParserError
 from django.db import connection
-from life.models import Tree as ElmoTree, Repository, Forest, Push
+from django.db.models import Max
+from life.models import (Tree as ElmoTree, Repository, Forest, Push,
+                         Changeset)
 
+import localrepos
 import logger
+import tips
 import util
 
 
+metrics = markus.get_metrics('elmo-builds')
+
+# priority classes of compare builds, most urgent first:
+# a push to a locale, a locale added to all-locales,
+# a change to en-US, and a tree with new l10n.ini data
+PRIORITIES = ('locale', 'all-locales', 'en-US', 'tree')
+
+
 def timeHelper(t):
     if t is None:
         return t
     return datetime.utcfromtimestamp(t)
 
 
+def _discard(mapping, key, value):
+    '''Remove value from the set in mapping[key], drop the key if empty.
+    '''
+    values = mapping.get(key)
+    if values is None:
+        return
+    values.discard(value)
+    if not values:
+        del mapping[key]
+
+
+def _str(obj):
+    '''Convert the unicode strings in JSON data to str.
+    '''
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_str(v) for v in obj]
+    if isinstance(obj, dict):
+        return dict((_str(k), _str(v)) for k, v in obj.iteritems())
+    return obj
+
+
 def try_log(f):
     def wrapped(*args, **kwargs):
         try:
@@ -70,35 +107,191 @@ class Tree(ComparableMixin):
             else:
                 self.l10ninis[branch] = [l10nini]
 
+    def asDict(self):
+        '''Serialize the tree data for the scheduler state file.
+        '''
+        return {
+            'name': self.name,
+            'repo': self.repo,
+            'branches': self.branches,
+            'l10ninis': self.l10ninis,
+            'all_locales': self.all_locales,
+            'locales': self.locales,
+            'branch2dirs': self.branch2dirs,
+            'tld': self.tld,
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        '''Create a Tree from the data stored by asDict.
+        '''
+        data = _str(data)
+        tree = cls(data['name'], data['repo'], data['branches']['en'],
+                   data['branches']['l10n'], None)
+        for attr in ('branches', 'l10ninis', 'all_locales', 'locales',
+                     'branch2dirs', 'tld'):
+            setattr(tree, attr, data[attr])
+        return tree
+
+
+class InflightBuildset(object):
+    '''A submitted compare buildset, with the revisions it compares.
+
+    Keeps track of the builds started for its requests, so that they
+    can be stopped when a newer buildset supersedes this one.
+    '''
+    def __init__(self, buildset, srctime, revisions, push=None):
+        self.buildset = None
+        self.srctime = srctime
+        self.revisions = revisions
+        # id of the newest push of the revisions
+        self.push = push
+        self.builds = []
+        if buildset is not None:
+            self.track(buildset)
+
+    def track(self, buildset):
+        '''Keep track of the builds of the submitted buildset.
+        '''
+        self.buildset = buildset
+        for req in getattr(buildset, 'requests', []):
+            req.subscribe(self.builds.append)
+
+    def supersededBy(self, other):
+        '''Check if other compares strictly newer revisions.
+        '''
+        if other.revisions == self.revisions:
+            return False
+        if self.srctime is None or other.srctime is None:
+            return False
+        if other.srctime != self.srctime:
+            return other.srctime > self.srctime
+        # pushes within the same second
+        if self.push is None or other.push is None:
+            return False
+        return other.push > self.push
+
+    def isCancelled(self):
+        '''Check if all requests got cancelled before they started.
+
+        Requests cancelled in the web status are just dropped from the
+        queue of their builder, and never finish the buildset.
+        Requests the builder picked are in one of its builds, which only
+        tells them that it started once the slave accepted it.
+        '''
+        requests = getattr(self.buildset, 'requests', [])
+        if not requests or self.builds:
+            return False
+        for req in requests:
+            builder = req.builder
+            if builder is None or req in builder.buildable:
+                return False
+            for build in builder.building:
+                if req in build.requests:
+                    return False
+        return True
+
 
 class AppScheduler(BaseUpstreamScheduler):
     """Scheduler used for app compare-locales builds.
     """
 
-    compare_attrs = ('name', 'builderNames', 'treebuilder', 'inipath', 'trees')
+    compare_attrs = ('name', 'builderNames', 'treebuilder', 'inipath', 'trees',
+                     'delay', 'maxWait', 'statefile', 'maxPending',
+                     'reloadInterval')
+
+    # version of the format of the state file, bump on incompatible changes
+    STATE_VERSION = 1
 
     class BranchData:
         '''Helper class that caches the data of all trees per hg branch.
         '''
         def __init__(self):
-            self.inis = defaultdict(list)
-            self.dirs = defaultdict(list)
+            self.inis = defaultdict(set)
+            self.dirs = defaultdict(set)
             self.topleveltrees = set()
             self.all_locales = defaultdict(set)
 
         def addDirs(self, tree, dirs):
             for d in dirs:
-                self.dirs[d].append(tree)
+                self.dirs[d].add(tree)
+
+        def removeTree(self, tree, dirs, inis, all_locales=None):
+            '''Remove the tree from the given dirs and l10n.inis,
+            and from the all-locales and top-level caches.
+            '''
+            for d in dirs:
+                _discard(self.dirs, d, tree)
+            for ini in inis:
+                _discard(self.inis, ini, tree)
+            if all_locales is not None:
+                _discard(self.all_locales, all_locales, tree)
+            self.topleveltrees.discard(tree)
+
+        def isEmpty(self):
+            return not (self.inis or self.dirs or
+                        self.topleveltrees or self.all_locales)
 
     class L10nDirs(defaultdict):
+        '''Trees per l10n module dir.
+
+        Keeps a prefix trie of the dirs next to the mapping, so that
+        treesForFile doesn't need to compare a path with every dir.
+        '''
         def __init__(self):
             defaultdict.__init__(self, set)
+            # nested dicts per character, None keys hold the dir
+            self.trie = {}
 
         def addDirs(self, tree, dirs):
             for d in dirs:
+                if d not in self:
+                    self._addPrefix(d)
                 self[d].add(tree)
 
-    def __init__(self, name, builderNames, inipath, treebuildername):
+        def removeDirs(self, tree, dirs):
+            for d in dirs:
+                _discard(self, d, tree)
+                if d not in self:
+                    self._removePrefix(d)
+
+        def treesForFile(self, path):
+            '''Get the trees for all dirs that the path starts with.
+            '''
+            trees = set()
+            node = self.trie
+            for c in path:
+                if None in node:
+                    trees |= self[node[None]]
+                node = node.get(c)
+                if node is None:
+                    return trees
+            if None in node:
+                trees |= self[node[None]]
+            return trees
+
+        def _addPrefix(self, d):
+            node = self.trie
+            for c in d:
+                node = node.setdefault(c, {})
+            node[None] = d
+
+        def _removePrefix(self, d):
+            nodes = [self.trie]
+            for c in d:
+                if c not in nodes[-1]:
+                    return
+                nodes.append(nodes[-1][c])
+            nodes[-1].pop(None, None)
+            # prune nodes that lead nowhere anymore
+            for i in xrange(len(d), 0, -1):
+                if nodes[i]:
+                    break
+                del nodes[i - 1][d[i - 1]]
+
+    def __init__(self, name, builderNames, inipath, treebuildername,
+                 delay=0, maxWait=None, statefile=None, maxPending=None,
+                 reloadInterval=None):
         """
         @param name: the name of this Scheduler
         @param builderNames: a list of Builder names. When this Scheduler
@@ -107,6 +300,18 @@ class AppScheduler(BaseUpstreamScheduler):
         @param inipath: path to l10nbuilds.ini, describing the apps
         @param treebuildername: the name of the builder that collects
                                 tree info from remote l10n.ini files
+        @param delay: seconds to wait for more changes before submitting
+                      the pending buildsets. Each change restarts the wait.
+        @param maxWait: maximum seconds to wait after the first pending
+                        change before submitting, None for no limit
+        @param statefile: path to a file to store the tree data in, used
+                          to start without waiting for the tree builds
+        @param maxPending: maximum number of compare buildsets that are
+                           submitted and not finished, None for no limit.
+                           Changes for further builds are merged per
+                           tree and locale until buildsets finish.
+        @param reloadInterval: seconds between checks if inipath changed,
+                               None to only read it on startup
         """
 
         BaseUpstreamScheduler.__init__(self, name)
@@ -117,6 +322,12 @@ class AppScheduler(BaseUpstreamScheduler):
             assert os.path.exists(inipath)
         self.inipath = inipath
         self.treebuilder = treebuildername
+        self.statefile = statefile
+        self.reloadInterval = reloadInterval
+        # the sections of inipath, and its mtime
+        self.buildsIni = {}
+        self.buildsIniTime = None
+        self.reloader = None
         self.trees = {}
         # just volatile data below
         # cache tree data per hg repo branch
@@ -124,11 +335,29 @@ class AppScheduler(BaseUpstreamScheduler):
         self.l10nbranches = defaultdict(self.L10nDirs)
         # map tree/locale tuples to list of changes
         self.pendings = defaultdict(list)
+        # map tree/locale tuples to the priority of the buildset
+        self.priorities = {}
+        # map tree/locale tuples to the time they got pending
+        self.pendingSince = {}
         self.dSubmitBuildsets = None
-        # deferred that's non-None if a tree builds are currently running
+        self.maxPending = maxPending
+        self.outstanding = 0  # submitted buildsets that didn't finish yet
+        # map tree/locale tuples to InflightBuildsets
+        self.inflight = defaultdict(list)
+        self.delay = delay
+        self.maxWait = maxWait
+        self.firstPending = None  # time of the first pending change
+        self.coalesced = 0  # compare builds merged into pending ones
+        # deferred that's non-None if the tree builds on startup are running
         self.waitOnTree = None
-        self.pendingChanges = []
-        self.treesToDo = set()  # trees that changed on a tree build
+        # count of running tree builds per branch
+        self.gatedBranches = defaultdict(int)
+        # changes waiting for tree builds, in order
+        self.pendingChanges = deque()
+        # trees that changed on a tree build, per change that triggered
+        # the build, None for the builds on startup and reload
+        self.treesToDo = defaultdict(set)
+        self.dSaveState = None
         self.timeout = 5
         self.headers = {
             'User-Agent': 'Elmo/1.0 (l10n.mozilla.org)'
@@ -149,8 +378,9 @@ class AppScheduler(BaseUpstreamScheduler):
                              'Tree info for %s loaded, unchanged' % tree.name)
                 return
             # updated tree. Add this to treesToDo, which will be picked up
-            # by checkEnUS, called after the buildset is done
-            self.treesToDo.add(tree.name)
+            # by checkEnUS for the change, or by onTreesBuilt, called
+            # after the buildset is done
+            self.treesToDo[changes[-1] if changes else None].add(tree.name)
         # tree is new or changed, update django database
         forest, isnew = \
             Forest.objects.get_or_create(name=tree.branches['l10n'])
@@ -166,31 +396,66 @@ class AppScheduler(BaseUpstreamScheduler):
             tree_.save()
             log.msg("scheduler updated %s.l10n to %s" %
                     (tree_.code, forest.name))
+        old_tree = self.trees.get(tree.name)
         self.trees[tree.name] = tree
         logger.debug("scheduler.l10n", "updated tree " + tree.name)
+        self.stateChanged()
         try:
-            # update caches of tree data
-            self.branches.clear()
-            self.l10nbranches.clear()
-            for _n, _t in self.trees.iteritems():
-                for _b, dirs in _t.branch2dirs.iteritems():
-                    self.branches[_b].addDirs(_n, dirs)
-                    self.l10nbranches[_t.branches['l10n']].addDirs(_n, dirs)
-                for _b, inis in _t.l10ninis.iteritems():
-                    for ini in inis:
-                        self.branches[_b].inis[ini].append(_n)
-                if _t.tld is not None:
-                    (self.l10nbranches[_t.branches['l10n']]
-                         .addDirs(_n, [_t.tld]))
-                    self.branches[_t.branches['en']].topleveltrees.add(_n)
-                if _t.all_locales is not None:
-                    (self.branches[_t.branches['en']]
-                         .all_locales[_t.all_locales]
-                         .add(_n))
+            # update caches of tree data, only for the tree that changed
+            if old_tree is not None:
+                self.removeTreeData(tree.name, old_tree)
+            self.addTreeData(tree.name, tree)
         except Exception, e:
             log.msg(str(e))
         logger.debug("scheduler.l10n", "branch data cache updated")
 
+    def addTreeData(self, name, tree):
+        '''Add the data of a single tree to the caches per branch.
+        '''
+        l10nbranch = tree.branches['l10n']
+        for _b, dirs in tree.branch2dirs.iteritems():
+            self.branches[_b].addDirs(name, dirs)
+            self.l10nbranches[l10nbranch].addDirs(name, dirs)
+        for _b, inis in tree.l10ninis.iteritems():
+            for ini in inis:
+                self.branches[_b].inis[ini].add(name)
+        if tree.tld is not None:
+            self.l10nbranches[l10nbranch].addDirs(name, [tree.tld])
+            self.branches[tree.branches['en']].topleveltrees.add(name)
+        if tree.all_locales is not None:
+            (self.branches[tree.branches['en']]
+                 .all_locales[tree.all_locales]
+                 .add(name))
+
+    def removeTreeData(self, name, tree):
+        '''Remove the data of a single tree from the caches per branch.
+
+        This undoes addTreeData for the given tree, and drops branches
+        that no other tree refers to.
+        '''
+        l10nbranch = tree.branches['l10n']
+        enbranch = tree.branches['en']
+        affected = set(tree.branch2dirs) | set(tree.l10ninis) | {enbranch}
+        for _b in affected:
+            if _b not in self.branches:
+                continue
+            branchdata = self.branches[_b]
+            branchdata.removeTree(
+                name,
+                tree.branch2dirs.get(_b, []),
+                tree.l10ninis.get(_b, []),
+                all_locales=tree.all_locales if _b == enbranch else None)
+            if branchdata.isEmpty():
+                del self.branches[_b]
+        if l10nbranch in self.l10nbranches:
+            l10ndirs = self.l10nbranches[l10nbranch]
+            for dirs in tree.branch2dirs.itervalues():
+                l10ndirs.removeDirs(name, dirs)
+            if tree.tld is not None:
+                l10ndirs.removeDirs(name, [tree.tld])
+            if not l10ndirs:
+                del self.l10nbranches[l10nbranch]
+
     def startService(self):
         BaseUpstreamScheduler.startService(self)
         log.msg("starting l10n scheduler")
@@ -198,11 +463,47 @@ class AppScheduler(BaseUpstreamScheduler):
             # testing, don't trigger tree builds
             return
         # trigger tree builds for our trees, clear() first
+        self.buildsIniTime, self.buildsIni = self.readBuildsIni()
+        self.trees.clear()
+        self.branches.clear()
+        self.l10nbranches.clear()
+        # start with the trees we had, if we have them
+        loaded = self.loadState(self.buildsIni.keys())
+        d = self.buildTrees(sorted(self.buildsIni))
+        d.addCallback(self.onTreesBuilt)
+        if not loaded:
+            # we don't know any trees, wait for them to be built
+            self.waitOnTree = d
+        if self.reloadInterval is not None:
+            self.reloader = task.LoopingCall(self.checkBuildsIni)
+            self.reloader.start(self.reloadInterval, now=False)
+
+    def stopService(self):
+        if self.reloader is not None and self.reloader.running:
+            self.reloader.stop()
+        if self.dSaveState is not None and self.dSaveState.active():
+            self.dSaveState.cancel()
+            self.saveState()
+        return BaseUpstreamScheduler.stopService(self)
+
+    def readBuildsIni(self):
+        '''Parse inipath into a dict of sections to their options.
+
+        Returns the mtime of the file, and the sections.
+        '''
+        mtime = os.path.getmtime(self.inipath)
         cp = ConfigParser()
         cp.read(self.inipath)
-        self.trees.clear()
+        return mtime, dict((section, dict(cp.items(section)))
+                           for section in cp.sections())
+
+    def buildTrees(self, trees):
+        '''Submit tree builds for the given tree names.
+
+        Returns a DeferredList for the buildsets.
+        '''
         _ds = []
-        for tree in cp.sections():
+        for tree in trees:
             # create a BuildSet, submit it to the BuildMaster
             props = properties.Properties()
             props.update({
@@ -215,40 +516,192 @@ class AppScheduler(BaseUpstreamScheduler):
                                    properties=props)
             self.submitBuildSet(bs)
             _ds.append(bs.waitUntilFinished())
-        d = defer.DeferredList(_ds)
-        d.addCallback(self.onTreesBuilt)
-        self.waitOnTree = d
+        return defer.DeferredList(_ds)
+
+    @try_log
+    def checkBuildsIni(self):
+        '''Reload inipath if it changed, and update the trees in the
+        sections that got added, changed or removed.
+        '''
+        try:
+            if os.path.getmtime(self.inipath) == self.buildsIniTime:
+                return
+            mtime, sections = self.readBuildsIni()
+        except (OSError, ConfigParserError), e:
+            log.msg('failed to reload %s: %s' % (self.inipath, str(e)))
+            return
+        old = self.buildsIni
+        self.buildsIniTime, self.buildsIni = mtime, sections
+        removed = sorted(set(old) - set(sections))
+        added = sorted(set(sections) - set(old))
+        changed = sorted(_n for _n in set(sections) & set(old)
+                         if sections[_n] != old[_n])
+        log.msg('reloaded %s, added: %s, changed: %s, removed: %s' %
+                (self.inipath, ', '.join(added), ', '.join(changed),
+                 ', '.join(removed)))
+        for _n in removed:
+            self.removeTree(_n)
+        if not (added or changed):
+            return
+        d = self.buildTrees(added + changed)
+        # hold back changes on the branches of the trees we know
+        gated = self.treeBranches(_n for _n in changed if _n in self.trees)
+        for b in gated:
+            self.gatedBranches[b] += 1
+        d.addCallback(self.onTreesReloaded, added, gated)
+
+    def onTreesReloaded(self, res, added, gated):
+        # compare all locales of the new trees, and of the changed
+        # ones, which addTree put into treesToDo
+        self.treesToDo[None].update(_n for _n in added if _n in self.trees)
+        self.onTreesBuilt(res, gated=gated)
+
+    def removeTree(self, name):
+        '''Drop the tree from our caches, and its pending builds.
+        '''
+        tree = self.trees.pop(name, None)
+        if tree is None:
+            return
+        self.removeTreeData(name, tree)
+        for key in self.treesToDo.keys():
+            _discard(self.treesToDo, key, name)
+        for tpl in [tpl for tpl in self.pendings if tpl[0] == name]:
+            del self.pendings[tpl]
+            self.priorities.pop(tpl, None)
+            self.pendingSince.pop(tpl, None)
+        self.stateChanged()
+
+    def loadState(self, treenames):
+        '''Load the trees in treenames from the state file.
 
-    def onTreesBuilt(self, res, branchdata=None, change=None):
+        Returns True if trees got loaded.
+        '''
+        if self.statefile is None or not os.path.exists(self.statefile):
+            return False
+        try:
+            with open(self.statefile) as f:
+                state = json.load(f)
+            if state['version'] != self.STATE_VERSION:
+                log.msg('ignoring state file of version %s' %
+                        state['version'])
+                return False
+            trees = [Tree.fromDict(t) for t in state['trees']]
+        except (IOError, ValueError, KeyError, TypeError), e:
+            log.msg('failed to load state from %s: %s' %
+                    (self.statefile, str(e)))
+            return False
+        for tree in trees:
+            if tree.name not in treenames:
+                # removed from l10nbuilds.ini
+                continue
+            self.trees[tree.name] = tree
+            self.addTreeData(tree.name, tree)
+        log.msg('loaded %d trees from %s' %
+                (len(self.trees), self.statefile))
+        return bool(self.trees)
+
+    def stateChanged(self):
+        '''Save the state file soon.
+        '''
+        if self.statefile is None or self.dSaveState is not None:
+            return
+        self.dSaveState = reactor.callLater(0, self.saveState)
+
+    def saveState(self):
+        self.dSaveState = None
+        state = {
+            'version': self.STATE_VERSION,
+            'trees': [t.asDict() for _n, t in sorted(self.trees.iteritems())],
+        }
+        tmppath = self.statefile + '.tmp'
+        try:
+            with open(tmppath, 'w') as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.rename(tmppath, self.statefile)
+        except (IOError, OSError), e:
+            log.msg('failed to save state to %s: %s' %
+                    (self.statefile, str(e)))
+
+    def onTreesBuilt(self, res, branchdata=None, change=None,
+                     gated=None):
         '''Callback used when all tree-builder buildsets are done.
-        If change is None, this is called from startService, otherwise
-        it's called as a follow up from a change-based build. If so,
-        call into checkEnUS.
-        After that, process all pending changes, as long as we're not
-        doing more tree builds again.
+        If change is None, this is called from startService or after
+        reloading the builds ini, otherwise it's called as a follow up
+        from a change-based build. If so, call into checkEnUS.
+        Open the branches in gated again.
+        After that, process all pending changes on branches that
+        aren't waiting for tree builds.
         '''
         # res is either None or list of tuple build sets
         logger.debug('scheduler.l10n',
                      'pending trees got built' +
                      (change is not None and ", change given" or ""))
-        # trees for the last change are built, wait no longer
-        self.waitOnTree = None
+        if gated is None:
+            # trees for all branches are built, wait no longer
+            self.waitOnTree = None
+        else:
+            for b in gated:
+                self.gatedBranches[b] -= 1
+                if self.gatedBranches[b] <= 0:
+                    del self.gatedBranches[b]
         log.msg("self.branches: %s" % str(self.branches))
         log.msg("self.l10nbranches: %s" % str(self.l10nbranches))
         if change is not None and branchdata is not None:
             self.checkEnUS(res, branchdata, change)
-        while self.waitOnTree is None and self.pendingChanges:
-            c = self.pendingChanges.pop(0)
-            self.addChange(c)
+        else:
+            # compare the trees that changed since the last state file,
+            # or since the last reload of the builds ini
+            for _n in self.treesToDo.pop(None, ()):
+                self.compareTree(_n, [], 'tree')
+        self.processPendingChanges()
+
+    def getInterests(self):
+        '''Get the en-US branches and l10n forests we need changes for.
+
+        Returns None while tree builds are running, as we don't know
+        all branches of our trees then.
+        '''
+        if self.waitOnTree is not None or self.gatedBranches:
+            return None
+        return set(self.branches), set(self.l10nbranches)
+
+    def isGated(self, change):
+        '''Check if the change needs to wait for running tree builds.
+        '''
+        return (self.waitOnTree is not None or
+                change.branch in self.gatedBranches)
+
+    def processPendingChanges(self):
+        '''Process the pending changes that don't wait on tree builds
+        anymore. Changes that still need to wait get queued again,
+        in the same order.
+        '''
+        pending, self.pendingChanges = self.pendingChanges, deque()
+        while pending:
+            self.addChange(pending.popleft())
+
+    def treeBranches(self, trees):
+        '''Get the branches, including l10n forests, whose data is
+        loaded by the tree builds of the given trees.
+        '''
+        branches = set()
+        for _n in trees:
+            _t = self.trees[_n]
+            branches.update(_t.branches.itervalues())
+            branches.update(_t.branch2dirs)
+            branches.update(_t.l10ninis)
+        return branches
 
     def addChange(self, change):
         '''Main entry point for the scheduler, this is called by the
         buildmaster.
         '''
-        log.msg("addChange appscheduler, %s" % str(self.waitOnTree))
-        if self.waitOnTree is not None:
-            # a tree build is currently running, wait with this
-            # until we're done with it
+        log.msg("addChange appscheduler, %s, gated branches: %s" %
+                (str(self.waitOnTree),
+                 ','.join(sorted(self.gatedBranches))))
+        if self.isGated(change):
+            # a tree build for this branch is currently running,
+            # wait with this until we're done with it
             self.pendingChanges.append(change)
             return
         # fixup change.locale if property is given
@@ -285,10 +738,14 @@ class AppScheduler(BaseUpstreamScheduler):
                                            properties=props)
                     self.submitBuildSet(bs)
                     _ds.append(bs.waitUntilFinished())
+                # hold back changes on the branches of those trees
+                gated = self.treeBranches(tree_triggers)
+                for b in gated:
+                    self.gatedBranches[b] += 1
                 d = defer.DeferredList(_ds)
                 d.addCallback(self.onTreesBuilt,
-                              branchdata=branchdata, change=change)
-                self.waitOnTree = d
+                              branchdata=branchdata, change=change,
+                              gated=gated)
                 return
             self.checkEnUS(None, branchdata, change)
             return
@@ -301,12 +758,11 @@ class AppScheduler(BaseUpstreamScheduler):
         log.msg('yes, dirs: %s' % ','.join(sorted(l10ndirs)))
         trees = set()
         for f in change.files:
-            for mod, _trees in l10ndirs.iteritems():
-                if f.startswith(mod):
-                    trees |= _trees
+            trees |= l10ndirs.treesForFile(f)
         for _n in trees:
             if change.locale in self.trees[_n].locales:
-                self.compareBuild(_n, change.locale, [change])
+                self.compareBuild(_n, change.locale, [change],
+                                  priority='locale')
             else:
                 log.msg('%s not in tree %s, needs %s' % (
                     change.locale,
@@ -322,9 +778,9 @@ class AppScheduler(BaseUpstreamScheduler):
         logger.debug('scheduler.l10n',
                      'checking en-US for change %d' % change.number)
         all_locales = set()
-        # pick up trees from onTreesBuilt
-        en_US = set(self.treesToDo)
-        self.treesToDo.clear()
+        # pick up the trees that the tree builds for this change updated,
+        # map trees to priority
+        en_US = dict.fromkeys(self.treesToDo.pop(change, ()), 'tree')
         for f in change.files:
             if f in branchdata.all_locales:
                 all_locales.update(branchdata.all_locales[f])
@@ -335,27 +791,47 @@ class AppScheduler(BaseUpstreamScheduler):
                 if not mod:
                     # single-module-hg, aka mobile
                     for _n in branchdata.topleveltrees:
-                        for l in self.trees[_n].locales:
-                            self.compareBuild(_n, l, [change])
+                        self.compareTree(_n, [change], 'en-US')
                 else:
                     if mod in branchdata.dirs:
-                        en_US.update(branchdata.dirs[mod])
-        # load all-locales files
+                        en_US.update(dict.fromkeys(branchdata.dirs[mod],
+                                                   'en-US'))
+        # load all-locales files, concurrently and off the reactor,
+        # from the local clones if we can
         rev = 'default'
+        _ds = []
         for _n in all_locales:
             if change.revision is not None:
                 rev = change.revision
             _t = self.trees[_n]
             url = _t.repo + '/' + _t.branches['en'] + '/raw-file/' + rev
             url += '/' + _t.all_locales
-            request = urllib2.Request(url, headers=self.headers)
-            page = urllib2.urlopen(request, timeout=self.timeout).read()
-            self.onAllLocales(page, _n, change)
+            d = localrepos.files.getFile(_t.repo, _t.branches['en'], rev,
+                                         _t.all_locales,
+                                         agent=self.headers['User-Agent'],
+                                         timeout=self.timeout)
+            d.addCallback(self.onAllLocales, _n, change)
+            d.addErrback(self.allLocalesFailed, _n, url)
+            if _n in en_US:
+                # trigger all locales once we know them
+                d.addCallback(self.onAllLocalesDone, _n, change,
+                              en_US.pop(_n))
+            _ds.append(d)
         # trigger all locales for all trees
-        for _n in en_US:
-            _t = self.trees[_n]
-            for l in _t.locales:
-                self.compareBuild(_n, l, [change])
+        for _n, priority in en_US.iteritems():
+            self.compareTree(_n, [change], priority)
+        return defer.DeferredList(_ds)
+
+    def onAllLocalesDone(self, result, tree, change, priority):
+        self.compareTree(tree, [change], priority)
+
+    def allLocalesFailed(self, failure, tree, url):
+        log.msg('loading all-locales for %s from %s failed: %s' %
+                (tree, url, failure.getErrorMessage()))
+
+    def compareTree(self, tree, changes, priority):
+        for l in self.trees[tree].locales:
+            self.compareBuild(tree, l, changes, priority=priority)
 
     def onAllLocales(self, page, tree, change=None):
         newlocs = util.parseLocales(page)
@@ -366,66 +842,231 @@ class AppScheduler(BaseUpstreamScheduler):
                       ', '.join(list(newlocs)),
                       ', '.join(list(added))))
         self.trees[tree].locales = newlocs
+        self.stateChanged()
         for loc in added:
-            self.compareBuild(tree, loc, [change])
+            self.compareBuild(tree, loc, [change], priority='all-locales')
 
-    def compareBuild(self, tree, locale, changes):
+    def compareBuild(self, tree, locale, changes, priority='locale'):
+        '''Schedule a compare build for the tree and locale.
+
+        priority is one of PRIORITIES, the most urgent one of all
+        merged changes is used for the buildset.
+        '''
+        if (tree, locale) in self.pendings:
+            self.coalesced += 1
+        else:
+            self.pendingSince[(tree, locale)] = time.time()
+        current = self.priorities.get((tree, locale), PRIORITIES[-1])
+        if PRIORITIES.index(priority) <= PRIORITIES.index(current):
+            self.priorities[(tree, locale)] = priority
         cs = self.pendings[(tree, locale)]
         if changes is not None:
-            cs += changes
+            cs += [c for c in changes if c not in cs]
+        now = time.time()
         if self.dSubmitBuildsets is None:
-            self.dSubmitBuildsets = reactor.callLater(0, self.submitBuildsets)
+            self.firstPending = now
+            self.dSubmitBuildsets = reactor.callLater(self.delay,
+                                                      self.submitBuildsets)
+        elif self.delay and self.dSubmitBuildsets.active():
+            # debounce, but don't wait longer than maxWait
+            when = now + self.delay
+            if self.maxWait is not None:
+                when = min(when, self.firstPending + self.maxWait)
+            self.dSubmitBuildsets.reset(max(when - now, 0))
+
+    def resolveRepositories(self, names):
+        '''Load the given repositories with the latest push on the
+        'default' branch and its tip, in a fixed number of queries.
+
+        Returns a dict mapping repository names to tuples of
+        (repository, push date, revision, push id). Push date and id
+        are None if there's no push on the 'default' branch.
+
+        Pushes are taken from the tip cache if possible, and the cache is
+        filled with the pushes that we load from the database.
+        '''
+        repos = dict((r.name, r) for r in
+                     Repository.objects
+                     .filter(name__in=names)
+                     .select_related('forest'))
+        if not repos:
+            return {}
+        rv = {}
+        for name, repo in repos.items():
+            tip = tips.cache.get(name)
+            if tip is not None:
+                rv[name] = (repo, tip[1], tip[2], tip[0])
+                del repos[name]
+        if not repos:
+            return rv
+        latest = self.latestPushes(repos.values())
+        for name, repo in repos.iteritems():
+            push_id, push_date, revision = latest[repo.id]
+            if push_id is not None:
+                tips.cache.update(name, push_id, push_date, revision)
+            rv[name] = (repo, push_date, revision, push_id)
+        return rv
+
+    def latestPushes(self, repos, when=None):
+        '''Get the latest push on the 'default' branch and its tip for
+        each of the given repositories, in a fixed number of queries.
+        If when is given, only pushes not newer than when are considered.
+
+        Returns a dict mapping repository ids to tuples of
+        (push id, push date, revision). Push id and date are None if
+        there's no such push, the revision is the head of the 'default'
+        branch then.
+        '''
+        ids = [r.id for r in repos]
+        pushes = Push.objects.filter(repository__in=ids,
+                                     changesets__branch__name='default')
+        if when is not None:
+            pushes = pushes.filter(push_date__lte=when)
+        latest_pushes = dict(
+            pushes
+            .order_by()
+            .values('repository')
+            .annotate(latest=Max('id'))
+            .values_list('repository', 'latest'))
+        # get the latest changeset on the 'default' branch
+        #  not strictly .tip, for pushes with heads on
+        #  multiple branches (bug 602182)
+        push_tips = {}
+        if latest_pushes:
+            push_tips = dict(
+                (push_id, (push_date, tip_id))
+                for push_id, push_date, tip_id in
+                Push.objects
+                .filter(id__in=latest_pushes.values(),
+                        changesets__branch__name='default')
+                .order_by()
+                .values('id', 'push_date')
+                .annotate(tip=Max('changesets__id'))
+                .values_list('id', 'push_date', 'tip'))
+        # no pushes, try to get a good Changeset.
+        # this is guaranteed to at least return the null changeset
+        no_pushes = [_id for _id in ids if _id not in latest_pushes]
+        heads = {}
+        if no_pushes:
+            heads = dict(
+                Repository.objects
+                .filter(id__in=no_pushes,
+                        changesets__branch__name='default')
+                .order_by()
+                .values('id')
+                .annotate(head=Max('changesets__id'))
+                .values_list('id', 'head'))
+        changeset_ids = [tip_id for _d, tip_id in push_tips.itervalues()]
+        changeset_ids += heads.values()
+        revisions = dict(
+            Changeset.objects
+            .filter(id__in=changeset_ids)
+            .values_list('id', 'revision'))
+        rv = {}
+        for _id in ids:
+            push_id = latest_pushes.get(_id)
+            push_date = None
+            if push_id is not None:
+                push_date, cs = push_tips[push_id]
+            else:
+                cs = heads.get(_id)
+            rv[_id] = (push_id, push_date,
+                       str(revisions.get(cs, "000000000000")))
+        return rv
 
     @try_log
     def submitBuildsets(self):
         connection.close_if_unusable_or_obsolete()
-        log.msg('submitting %d pending buildsets' % len(self.pendings))
-        for tpl, changes in self.pendings.iteritems():
-            tree, locale = tpl
+        self.releaseCancelled()
+        self.dSubmitBuildsets = None
+        batch = self.pendings.keys()
+        if self.maxPending is not None:
+            slots = self.maxPending - self.outstanding
+            # most urgent and oldest first
+            batch.sort(key=lambda tpl: (
+                PRIORITIES.index(self.priorities.get(tpl, PRIORITIES[-1])),
+                self.pendingSince.get(tpl)))
+            batch = batch[:max(slots, 0)]
+        log.msg('submitting %d of %d pending buildsets, %d coalesced' %
+                (len(batch), len(self.pendings), self.coalesced))
+        metrics.incr('buildsets_submitted', len(batch))
+        metrics.incr('buildsets_coalesced', self.coalesced)
+        metrics.gauge('buildsets_held_back', len(self.pendings) - len(batch))
+        self.coalesced = 0
+        if not batch:
+            return
+        # resolve all repositories in this batch up front
+        repo_names = set()
+        forest_names = set()
+        for tree, locale in batch:
             _t = self.trees[tree]
-            props = properties.Properties()
-            # figure out the latest change
+            for k, v in _t.branches.iteritems():
+                repo_names.add('%s/%s' % (v, locale) if k == 'l10n' else v)
+            forest_names.add(_t.branches['l10n'])
+        repos = self.resolveRepositories(repo_names)
+        forests = dict((f.name, f) for f in
+                       Forest.objects.filter(name__in=forest_names))
+        # figure out the latest change per tree and locale, and the
+        # repositories with a newer push than that, per change time.
+        # Without a change time, the first repository with a push
+        # bounds the following ones.
+        changed = {}
+        bounded = defaultdict(dict)
+        for tpl in batch:
+            tree, locale = tpl
             try:
-                when = timeHelper(max(filter(None, (c.when for c in changes))))
+                when = timeHelper(max(filter(None, (c.when for c in
+                                                    self.pendings[tpl]))))
             except (ValueError, ImportError):
                 when = None
+            for k, v in self.trees[tree].branches.iteritems():
+                name = '%s/%s' % (v, locale) if k == 'l10n' else v
+                if name not in repos:
+                    continue
+                repo, push_date, _r, push_id = repos[name]
+                if push_date is None:
+                    continue
+                if when is None:
+                    when = push_date
+                elif push_date > when:
+                    bounded[when][repo.id] = repo
+            changed[tpl] = when
+        # find older pushes for those, in one go per change time.
+        # don't use the tip cache for that, it only knows about the
+        # latest push
+        older = dict((when, self.latestPushes(_repos.values(), when))
+                     for when, _repos in bounded.iteritems())
+        for tpl in batch:
+            changes = self.pendings.pop(tpl)
+            priority = self.priorities.pop(tpl, PRIORITIES[-1])
+            self.pendingSince.pop(tpl, None)
+            tree, locale = tpl
+            _t = self.trees[tree]
+            props = properties.Properties()
+            when = changed[tpl]
             revisions = sorted(_t.branches.keys())
+            resolved = {}
+            newest = None
             for k, v in _t.branches.iteritems():
-                _r = "000000000000"
                 if k == 'l10n':
                     repo = '%s/%s' % (v, locale)
                 else:
                     repo = v
-                try:
-                    repo = Repository.objects.get(name=repo)
-                except Repository.DoesNotExist:
+                if repo not in repos:
                     log.msg('Repository %s does not exist, skipping' % repo)
                     revisions.remove(k)
                     continue
-                q = Push.objects.filter(repository=repo,
-                                        changesets__branch__name='default')
-                if when is not None:
-                    q = q.filter(push_date__lte=when)
-                try:
-                    # get the latest changeset on the 'default' branch
-                    #  not strictly .tip, for pushes with heads on
-                    #  multiple branches (bug 602182)
-                    _p = q.order_by('-pk')[0]
-                    if _p.push_date:
-                        if not when:
-                            when = _p.push_date
-                        else:
-                            when = max(when, _p.push_date)
-                    _c = _p.changesets.order_by('-pk')
-                    _r = str(_c.filter(branch__name='default')[0].revision)
-                except IndexError:
-                    # no pushes, try to get a good Changeset.
-                    # this is guaranteed to at least return the null changeset
-                    _r = str(
-                        repo.changesets
-                        .filter(branch__name='default')
-                        .order_by('-pk')
-                        .values_list('revision', flat=True)[0])
+                repo, push_date, _r, push_id = repos[repo]
+                if (push_date is not None and changed[tpl] is not None and
+                        push_date > changed[tpl]):
+                    # the latest push is too new, use the older one
+                    push_id, push_date, _r = older[changed[tpl]][repo.id]
+                newest = max(newest, push_id)
+                if push_date:
+                    if not when:
+                        when = push_date
+                    else:
+                        when = max(when, push_date)
                 relpath = repo.relative_path()
                 props.setProperty(k+"_branch", relpath,
                                   "Scheduler")
@@ -433,7 +1074,8 @@ class AppScheduler(BaseUpstreamScheduler):
                     props.setProperty("local_" + repo.name, relpath,
                                       "Scheduler")
                 props.setProperty(k+"_revision", _r, "Scheduler")
-            _f = Forest.objects.get(name=_t.branches['l10n'])
+                resolved[k] = _r
+            _f = forests[_t.branches['l10n']]
             # use the relative path of the en repo we got above
             inipath = '{}/{}'.format(
                 props['en_branch'],
@@ -444,12 +1086,84 @@ class AppScheduler(BaseUpstreamScheduler):
                           "inipath": inipath,
                           "srctime": when,
                           "revisions": revisions,
+                          "priority": priority,
                           },
                          "Scheduler")
+            inflight = InflightBuildset(None, when, resolved, newest)
+            # the changes of superseded compares go into this one
+            superseded = self.supersede(tpl, inflight)
+            changes = superseded + [c for c in changes
+                                    if c not in superseded]
             bs = buildset.BuildSet(self.builderNames,
                                    SourceStamp(changes=changes),
                                    properties=props)
             self.submitBuildSet(bs)
+            inflight.track(bs)
+            self.inflight[tpl].append(inflight)
+            self.outstanding += 1
+            bs.waitUntilFinished().addBoth(self.buildsetFinished,
+                                           tpl, inflight)
             log.msg('one buildset successfully submitted')
-        self.dSubmitBuildsets = None
-        self.pendings.clear()
+
+    def supersede(self, tpl, newer):
+        '''Cancel queued requests and stop running builds for the
+        tree and locale, which compare older revisions than newer.
+
+        Returns the changes of the cancelled and stopped compares,
+        which newer needs to compare instead.
+        '''
+        changes = []
+        for inflight in self.inflight.get(tpl, [])[:]:
+            if not inflight.supersededBy(newer):
+                continue
+            log.msg('superseding compare of %s for %s' % tpl[::-1])
+            metrics.incr('buildsets_superseded')
+            dropped = False
+            requests = getattr(inflight.buildset, 'requests', [])
+            if requests and all([req.cancel() for req in requests[:]]):
+                # never started, and won't finish, free the slot
+                self.buildsetFinished(None, tpl, inflight)
+                dropped = True
+            for build in inflight.builds:
+                if build.finished:
+                    continue
+                locales = set(req.properties.getProperty('locale')
+                              for req in getattr(build, 'requests', []))
+                if len(locales) > 1:
+                    # batched with other locales, let it finish for those
+                    continue
+                if build.currentStep is None:
+                    # waiting for its locks, nothing to interrupt yet
+                    continue
+                # mark the build with what it got superseded by
+                build.setProperty('superseded',
+                                  ' '.join(sorted(newer.revisions.values())),
+                                  'Scheduler')
+                build.stopBuild('superseded by newer revisions')
+                dropped = True
+            if dropped:
+                changes += [c for c in inflight.buildset.source.changes
+                            if c not in changes]
+        return changes
+
+    def releaseCancelled(self):
+        '''Free the slots of buildsets whose requests got cancelled.
+        '''
+        for tpl, inflights in self.inflight.items():
+            for inflight in inflights[:]:
+                if inflight.isCancelled():
+                    log.msg('compare of %s for %s got cancelled' % tpl[::-1])
+                    self.buildsetFinished(None, tpl, inflight)
+
+    def buildsetFinished(self, result, tpl, inflight):
+        '''A compare buildset finished, submit pending ones in its slot.
+        '''
+        if inflight not in self.inflight.get(tpl, []):
+            # cancelled already
+            return
+        self.inflight[tpl].remove(inflight)
+        if not self.inflight[tpl]:
+            del self.inflight[tpl]
+        self.outstanding -= 1
+        if self.pendings and self.dSubmitBuildsets is None:
+            self.dSubmitBuildsets = reactor.callLater(0, self.submitBuildsets)
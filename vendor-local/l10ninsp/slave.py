@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, threads
 from twisted.python import log
 from twisted.python.failure import Failure
 
@@ -14,7 +14,7 @@ import codecs
 import json
 import os
 from compare_locales.paths import EnumerateSourceTreeApp
-from compare_locales.compare import compareProjects
+from compare_locales.compare import compareProjects, Observer
 from django.conf import settings
 from django.db import connection
 import elasticsearch
@@ -43,57 +43,117 @@ class InspectCommand(Command):
         if self.debug:
             log.msg('Compare started')
 
-        d = defer.Deferred()
-        connection.close_if_unusable_or_obsolete()
-        d.addCallback(self.doCompare)
-        reactor.callLater(0, d.callback, None)
+        # compare and report in a thread, to keep the reactor responsive
+        # to keepalives and status updates
+        d = threads.deferToThread(self.compareInThread)
         d.addBoth(self.finished)
         return d
 
+    def compareInThread(self):
+        '''Run doCompare with a database connection for this thread.
+        '''
+        connection.close_if_unusable_or_obsolete()
+        try:
+            return self.doCompare()
+        finally:
+            connection.close()
+
+    def sendStatusFromThread(self, status):
+        '''sendStatus from the compare thread, raising its errors.
+        '''
+        threads.blockingCallFromThread(reactor, self.sendStatus, status)
+
     def doCompare(self, *args):
-        locale, workdir = (self.args[k] for k in ('locale', 'workdir'))
-        log.msg('Starting to compare %s in %s' % (locale, workdir))
+        workdir = self.args['workdir']
+        # batched builds compare several locales, each with their own
+        # l10n revision and srctime
+        batch = self.args.get('locales') or [
+            {'locale': self.args['locale'], 'revs': self.args['revs'],
+             'srctime': self.args['srctime']}]
+        locales = [entry['locale'] for entry in batch]
+        log.msg('Starting to compare %s in %s' %
+                (', '.join(locales), workdir))
         log.msg(str(self.args))
-        self.sendStatus({'header': 'Comparing %s against en-US for %s\n'
-                         % (locale, workdir)})
+        self.sendStatusFromThread(
+            {'header': 'Comparing %s against en-US for %s\n'
+             % (', '.join(locales), workdir)})
         try:
-            loc = Locale.objects.get(code=self.args['locale'])
+            locs = [Locale.objects.get(code=code) for code in locales]
             build = Build.objects.get(id=self.args['build'])
         except Exception, e:
             log.msg(e)
             self.rc = EXCEPTION
             return
-        revs = []
-        for rev in self.args['revs']:
-            cs = None
-            try:
-                cs = Changeset.objects.get(revision__startswith=rev[:12])
-                revs.append(cs)
-            except (Changeset.DoesNotExist, Changeset.MultipleObjectsReturned):
-                log.msg("no changeset found for %s" % rev)
+        revs = [self.changesets(entry['revs']) for entry in batch]
         workingdir = os.path.join(self.builder.basedir, workdir)
         try:
-            observers = self._compare(workingdir, locale, args)
+            observers = self._compare(workingdir, locales, args)
         except Exception, e:
-            log.msg('%s comparison failed with %s' % (locale, str(e)))
+            log.msg('%s comparison failed with %s' %
+                    (', '.join(locales), str(e)))
             log.msg(Failure().getTraceback())
             self.rc = EXCEPTION
             return
-        self.rc = SUCCESS
+        if self.interrupted:
+            # superseded by a newer compare, don't report stale data
+            log.msg('%s comparison interrupted, not reporting' %
+                    ', '.join(locales))
+            self.rc = EXCEPTION
+            return
         tree = Tree.objects.get(code=self.args['tree'])
-        for observer in observers:
+        # the build result is the worst of all locales
+        rc = SUCCESS
+        for loc, locrevs, entry in zip(locs, revs, batch):
+            self.rc = SUCCESS
+            for observer in observers:
+                if len(locs) > 1:
+                    observer = self.forLocale(observer, loc.code)
+                try:
+                    self.report_compare_locales(build, locrevs, loc, tree,
+                                                observer, entry['srctime'])
+                except Exception, e:
+                    log.msg(e)
+                    self.rc = EXCEPTION
+                if self.rc == EXCEPTION:
+                    break
+            rc = max(rc, self.rc)
+        self.rc = rc
+
+    def changesets(self, revisions):
+        revs = []
+        for rev in revisions:
             try:
-                self.report_compare_locales(build, revs, loc, tree, observer)
-            except Exception, e:
-                log.msg(e)
-                self.rc = EXCEPTION
-            if self.rc == EXCEPTION:
-                return
-
-    def report_compare_locales(self, build, revs, loc, tree, observer):
+                cs = Changeset.objects.get(revision__startswith=rev[:12])
+                revs.append(cs)
+            except (Changeset.DoesNotExist, Changeset.MultipleObjectsReturned):
+                log.msg("no changeset found for %s" % rev)
+        return revs
+
+    def forLocale(self, observer, locale):
+        '''Get an Observer with just the results for locale.
+        '''
+        single = Observer(file_stats=observer.file_stats is not None)
+        if locale in observer.summary:
+            single.summary[locale].update(observer.summary[locale])
+        if observer.file_stats is not None and locale in observer.file_stats:
+            single.file_stats[locale].update(observer.file_stats[locale])
+        for parts, value in self._leaves(observer.details, ()):
+            if parts and parts[0] == locale:
+                single.details['/'.join(parts)].extend(value)
+        return single
+
+    def _leaves(self, tree, prefix):
+        if tree.value is not None:
+            yield prefix, tree.value
+        for key, branch in tree.branches.iteritems():
+            for leaf in self._leaves(branch, prefix + key):
+                yield leaf
+
+    def report_compare_locales(self, build, revs, loc, tree, observer,
+                               srctime):
         '''Add the results of compare-locales for a particular tree
         to the elmo data, creating a Run, and associating that with
-        the given build and revisions.
+        the given build, revisions and source time.
         Adding the details to ES.
         '''
         summary = observer.summary[loc.code]
@@ -112,7 +172,7 @@ class InspectCommand(Command):
             'locale': loc,
             'tree': tree,
             'build': build,
-            'srctime': self.args['srctime']}
+            'srctime': srctime}
         for k in ('missing', 'missingInFiles', 'obsolete', 'total',
                   'changed', 'unchanged', 'keys', 'completion', 'errors',
                   'report', 'warnings'):
@@ -127,7 +187,7 @@ class InspectCommand(Command):
         dbrun.save()
         dbrun.activate()
         try:
-            self.sendStatus({
+            self.sendStatusFromThread({
                 'stdout': codecs.utf_8_encode(observer.serialize())[0]})
         except Exception, e:
             log.msg('%s status sending failed with %s' % (loc.code, str(e)))
@@ -148,7 +208,7 @@ class InspectCommand(Command):
             return
         log.msg('es.index: ' + json.dumps(rv))
 
-    def _compare(self, workingdir, locale, args):
+    def _compare(self, workingdir, locales, args):
         inipath, l10nbase, redirects = (
             self.args[k]
             for k in ('inipath', 'l10nbase', 'redirects'))
@@ -157,7 +217,7 @@ class InspectCommand(Command):
                                          workingdir,
                                          os.path.join(workingdir, l10nbase),
                                          redirects,
-                                         [locale])
+                                         locales)
             observers = compareProjects(
                 [app.asConfig()],
                 file_stats=True)
@@ -166,6 +226,9 @@ class InspectCommand(Command):
             raise
         return observers
 
+    def interrupt(self):
+        self.interrupted = True
+
     def finished(self, *args):
         # sometimes self.rc isn't set here, no idea why
         try:
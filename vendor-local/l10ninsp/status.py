@@ -61,7 +61,13 @@ class MarkusStatusReceiver(StatusReceiverMultiService):
         changes = build.getChanges()
         src_times = filter(None, (c.getTimes()[0] for c in changes))
         if src_times:
-            metrics.timing('end_to_end_time', (end_time - min(src_times))*1000, tags=[builderName])
+            tags = [builderName]
+            try:
+                tags.append('priority:' + build.getProperty('priority'))
+            except KeyError:
+                pass
+            metrics.timing('end_to_end_time',
+                           (end_time - min(src_times))*1000, tags=tags)
         self.logPending()
         log.msg("finished build on %s with %s" %
                 (builderName, str(results)))
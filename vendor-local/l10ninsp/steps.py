@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from twisted.internet import defer
 from twisted.python import log
 from buildbot.process.buildstep import (
     BuildStep, LoggingBuildStep, LoggedRemoteCommand)
@@ -10,10 +11,10 @@ from buildbot.process.properties import WithProperties
 
 from ConfigParser import ConfigParser, NoSectionError, NoOptionError
 from cStringIO import StringIO
-import urllib2
 
 from mbdb.models import Build
 
+import localrepos
 import logger
 import util
 
@@ -30,7 +31,7 @@ class InspectLocale(LoggingBuildStep):
     descriptionDone = ["compare", "locales"]
 
     def __init__(self, master, workdir, inipath, l10nbase, redirects,
-                 locale, tree,
+                 locale, tree, locales=None,
                  **kwargs):
         """
         @type  master: string
@@ -51,6 +52,10 @@ class InspectLocale(LoggingBuildStep):
 
         @type  tree: string
         @param tree: The tree identifier for this branch/product combo.
+
+        @type  locales: list
+        @param locales: (locale, l10n revision, srctime) tuples to compare
+                        in one go, instead of just locale.
         """
 
         LoggingBuildStep.__init__(self, **kwargs)
@@ -61,6 +66,7 @@ class InspectLocale(LoggingBuildStep):
                      'redirects': redirects,
                      'locale': locale,
                      'tree': tree}
+        self.locales = locales
         self.master = master
 
     def describe(self, done=False):
@@ -93,8 +99,19 @@ class InspectLocale(LoggingBuildStep):
         for rev in self.build.getProperty('revisions'):
             ident = self.build.getProperty('%s_revision' % rev)
             args['revs'].append(ident)
-
-        self.descriptionDone = [args['locale'], args['tree']]
+        if self.locales:
+            # the localizations differ only in their l10n revision
+            revisions = self.build.getProperty('revisions')
+            args['locales'] = []
+            for locale, l10n_revision, srctime in self.locales:
+                revs = [l10n_revision if rev == 'l10n' else revision
+                        for rev, revision in zip(revisions, args['revs'])]
+                args['locales'].append({'locale': locale, 'revs': revs,
+                                        'srctime': srctime})
+            self.descriptionDone = ['%d locales' % len(self.locales),
+                                    args['tree']]
+        else:
+            self.descriptionDone = [args['locale'], args['tree']]
         cmd = LoggedRemoteCommand(self.cmd_name, args)
         self.startCommand(cmd, [])
 
@@ -106,19 +123,23 @@ class TreeLoader(BuildStep):
     it wouldn't be more work there if we'd use the slave, and then
     marshall the data through the network back to the master.
     '''
-    def __init__(self, treename, l10nbuilds, cb=None, **kwargs):
+    def __init__(self, treename, l10nbuilds, cb=None, maxFetches=4,
+                 **kwargs):
         '''Create a TreeLoader step. In addition to the standard arguments,
         treename is the name of the tree,
         l10nbuilds is the local ini file describing the builds,
-        cb is a callback with signature (tree, changes=None)
+        cb is a callback with signature (tree, changes=None),
+        maxFetches is the number of files loaded concurrently
         '''
         BuildStep.__init__(self, **kwargs)
         self.addFactoryArguments(treename=treename,
                                  l10nbuilds=l10nbuilds,
-                                 cb=cb)
+                                 cb=cb,
+                                 maxFetches=maxFetches)
         self.treename = treename
         self.l10nbuilds = l10nbuilds
         self.cb = cb
+        self.maxFetches = maxFetches
         self.timeout = 5
         self.headers = {
             'User-Agent': 'Elmo/1.0 (l10n.mozilla.org)'
@@ -128,6 +149,10 @@ class TreeLoader(BuildStep):
         from scheduler import Tree
         loog = self.addLog('stdio')
         self.pending = 0
+        self.failed = False
+        self.semaphore = defer.DeferredSemaphore(self.maxFetches)
+        # tree data per position in the include graph, see loadIni
+        self.inidata = {}
         properties = self.build.getProperties()
         self.rendered_tree = tree = properties.render(self.treename)
         l10nbuilds = properties.render(self.l10nbuilds)
@@ -150,20 +175,51 @@ class TreeLoader(BuildStep):
                      'Loading l10n.inis for %s, alllocales: %s' %
                      (self.rendered_tree, alllocales))
         self.loadIni(repo, branch, path, alllocales)
-        self.endLoad()
 
-    def loadIni(self, repo, branch, path, alllocales="no"):
-        url = repo + '/' + branch + '/raw-file/default/' + path
+    def revision(self, branch):
+        '''The revision to load files on branch from.
+
+        That's the revision of the latest change on that branch that
+        triggered this build, or the default head.
+        '''
+        for change in reversed(self.build.allChanges()):
+            if change.branch == branch and change.revision:
+                return change.revision
+        return 'default'
+
+    def fetch(self, repo, branch, path):
+        '''Load path from branch, with at most maxFetches loads running.
+
+        Returns the deferred and the URL to the file, for logging.
+        '''
+        self.pending += 1
+        rev = self.revision(branch)
+        url = repo + '/' + branch + '/raw-file/' + rev + '/' + path
+        d = self.semaphore.run(localrepos.files.getFile,
+                               repo, branch, rev, path,
+                               agent=self.headers['User-Agent'],
+                               timeout=self.timeout)
+        return d, url
+
+    def loadIni(self, repo, branch, path, alllocales="no", position=()):
+        '''Load the l10n.ini at path, and all its includes.
+
+        The includes are loaded concurrently, position is the path of
+        include indices from the tree's l10n.ini to this one. The data
+        is added to the tree in that order once all files are loaded,
+        so that the tree doesn't depend on the order of the responses.
+        '''
+        d, url = self.fetch(repo, branch, path)
         self.getLog('stdio').addStdout('\nloading %s\n' % url)
         self.step_status.setText(['loading', 'l10n.ini'])
         self.step_status.setText2([repo, branch, path])
-        self.pending += 1
-        request = urllib2.Request(url, headers=self.headers)
-        inicontent = urllib2.urlopen(request, timeout=self.timeout).read()
-        self.onL10niniLoad(inicontent, repo, branch, path, alllocales)
+        d.addCallback(self.onL10niniLoad, repo, branch, path, alllocales,
+                      position)
+        d.addErrback(self.onL10niniFail, url)
+        d.addBoth(self.fetchDone)
 
-    def onL10niniLoad(self, inicontent, repo, branch, path, alllocales):
-        self.pending -= 1
+    def onL10niniLoad(self, inicontent, repo, branch, path, alllocales,
+                      position=()):
         logger.debug('scheduler.l10n.tree',
                      'Loaded %s, alllocales: %s' % (path, alllocales))
         self.step_status.setText(['loaded', 'l10n.ini'])
@@ -193,10 +249,10 @@ class TreeLoader(BuildStep):
             loog.addStdout("adding a tld compare for %s on %s\n" %
                            (tld, branch))
 
-        self.tree.addData(branch, path, dirs, tld)
+        self.inidata[position] = (branch, path, dirs, tld)
 
         try:
-            for title, _path in cp.items('includes'):
+            for i, (title, _path) in enumerate(cp.items('includes')):
                 try:
                     # check if the load details are overloaded
                     details = dict(cp.items('include_%s' % title))
@@ -212,11 +268,13 @@ class TreeLoader(BuildStep):
                     if enbranch not in self.tree.branches.values():
                         self.tree.branches[title] = enbranch
                     self.loadIni(details['repo'], details['mozilla'],
-                                 details['l10n.ini'])
+                                 details['l10n.ini'],
+                                 position=position + (i,))
                 except NoSectionError:
                     loog.addStdout("need to load %s from %s\n" %
                                    (title, _path))
-                    self.loadIni(repo, branch, _path)
+                    self.loadIni(repo, branch, _path,
+                                 position=position + (i,))
         except NoSectionError:
             pass
         try:
@@ -226,28 +284,20 @@ class TreeLoader(BuildStep):
                 logger.debug('scheduler.l10n.tree',
                              'loading all-locales for %s from %s' %
                              (self.tree.name, allpath))
-                self.pending += 1
-                request = urllib2.Request(
-                    repo + '/' + branch + '/raw-file/default/' + allpath,
-                    headers=self.headers)
-                content = urllib2.urlopen(request, timeout=self.timeout).read()
-                self.allLocalesLoaded(content)
+                d, url = self.fetch(repo, branch, allpath)
+                d.addCallback(self.allLocalesLoaded)
+                d.addErrback(self.allLocalesFailed, url)
+                d.addBoth(self.fetchDone)
         except NoSectionError:
             pass
 
-    def onL10niniFail(self, failure):
-        self.pending -= 1
+    def onL10niniFail(self, failure, url):
+        self.failed = True
         loog = self.getLog('stdio')
-        loog.addStderr(failure.getErrorMessage())
-        if self.pending <= 0:
-            self.step_status.setText(
-                ['configure', self.rendered_tree, 'failed'])
-            self.step_status.setText2([])
-            self.finished(FAILURE)
-        return failure
+        loog.addStderr('loading %s failed: %s\n' %
+                       (url, failure.getErrorMessage()))
 
     def allLocalesLoaded(self, page):
-        self.pending -= 1
         locales = util.parseLocales(page)
         self.build.setProperty('locales', locales,
                                'Build')
@@ -255,27 +305,39 @@ class TreeLoader(BuildStep):
                      'all-locales loaded, found %s' %
                      str(locales))
 
-    def allLocalesFailed(self, failure):
+    def allLocalesFailed(self, failure, url):
+        self.failed = True
+        loog = self.getLog('stdio')
+        loog.addStderr('loading %s failed: %s\n' %
+                       (url, failure.getErrorMessage()))
+
+    def fetchDone(self, result):
+        '''Called after each load and its processing is done,
+        including the loads of its includes being started.
+        '''
         self.pending -= 1
         if self.pending <= 0:
-            self.step_status.setText(
-                ['configure', self.rendered_tree, 'failed'])
-            self.step_status.setText2([])
-            self.finished(FAILURE)
-        return failure
+            self.endLoad()
 
     def endLoad(self):
         logger.debug('scheduler.l10n.tree',
                      'load ended, pending jobs: %d' % self.pending)
-        if self.pending <= 0:
-            self.step_status.setText(['configured', self.rendered_tree])
+        if self.failed:
+            self.step_status.setText(
+                ['configure', self.rendered_tree, 'failed'])
             self.step_status.setText2([])
-            if self.cb is not None:
-                try:
-                    self.tree.locales = (self.build
-                                             .getProperties()
-                                             .getProperty('locales', [])[:])
-                    self.cb(self.tree, changes=self.build.allChanges())
-                except Exception, e:
-                    logger.debug('scheduler.l10n.tree', str(e))
-            self.finished(SUCCESS)
+            self.finished(FAILURE)
+            return
+        for position in sorted(self.inidata):
+            self.tree.addData(*self.inidata[position])
+        self.step_status.setText(['configured', self.rendered_tree])
+        self.step_status.setText2([])
+        if self.cb is not None:
+            try:
+                self.tree.locales = (self.build
+                                         .getProperties()
+                                         .getProperty('locales', [])[:])
+                self.cb(self.tree, changes=self.build.allChanges())
+            except Exception, e:
+                logger.debug('scheduler.l10n.tree', str(e))
+        self.finished(SUCCESS)
@@ -0,0 +1,380 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from buildbot.status.builder import EXCEPTION
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from datetime import datetime, timedelta
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import hashlib
+import os
+
+from l10ninsp import changes, tips
+
+
+class PollInterval(unittest.TestCase):
+    def test_backoff(self):
+        interval = changes.PollInterval(1, 10)
+        self.failUnlessEqual([interval.next(False) for i in xrange(5)],
+                             [2, 4, 8, 10, 10])
+        self.failUnlessEqual(interval.next(True), 1)
+        self.failUnlessEqual(interval.next(False), 2)
+
+
+class PushNotifications(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        self.path = os.path.join(basedir, 'pushes.sock')
+        self.notified = defer.Deferred()
+        self.count = 0
+
+        def notify():
+            self.count += 1
+            if self.count == 2:
+                self.notified.callback(None)
+        self.port = reactor.listenUNIX(
+            self.path, changes.PushNotificationFactory(notify))
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def test_notify(self):
+        # the stand-in for the pushes ingestion
+        changes.notifyPushes(self.path)
+        changes.notifyPushes(self.path, 'push 1234')
+        return self.notified
+
+
+class FakeBuilder:
+    def __init__(self):
+        self.buildable = []
+        self.building = []
+
+
+class FakeBotMaster:
+    def __init__(self):
+        self.builders = {'compare': FakeBuilder()}
+
+
+class FakeMaster:
+    def __init__(self):
+        self.botmaster = FakeBotMaster()
+        # no getInterests, so the change source loads all pushes
+        self.schedulers = [object()]
+
+    def allSchedulers(self):
+        return self.schedulers
+
+
+class FakeScheduler:
+    '''A scheduler that only needs changes for some branches and forests.
+    '''
+    def __init__(self, branches, forests=()):
+        self.interests = (set(branches), set(forests))
+
+    def getInterests(self):
+        return self.interests
+
+
+class FakeChangeMaster:
+    '''Collect the changes, and queue a build for each.
+    '''
+    def __init__(self):
+        self.parent = FakeMaster()
+        self.changes = []
+
+    def addChange(self, change):
+        self.changes.append(change)
+        self.parent.botmaster.builders['compare'].buildable.append(change)
+
+
+class ChangeSourceMixin:
+    def setUp(self):
+        self.changemaster = FakeChangeMaster()
+        tips.cache.clear()
+
+    def createPushes(self, name, files):
+        '''Create a push to the repository name for each list of files.
+        '''
+        from life.models import Branch, Changeset, File, Push, Repository
+        default, _ = Branch.objects.get_or_create(name='default')
+        repo, _ = Repository.objects.get_or_create(
+            name=name,
+            defaults={'url': 'http://localhost/' + name})
+        pushes = []
+        for paths in files:
+            cs = Changeset.objects.create(
+                revision=hashlib.sha1(
+                    name + str(Changeset.objects.count())).hexdigest(),
+                branch=default, description='push')
+            repo.changesets.add(cs)
+            for path in paths:
+                cs.files.add(File.objects.get_or_create(path=path)[0])
+            push = Push.objects.create(
+                repository=repo, user='jane', push_date=datetime.utcnow(),
+                push_id=Push.objects.filter(repository=repo).count() + 1)
+            push.changesets.add(cs)
+            pushes.append(push)
+        return pushes
+
+    def changeSource(self, **kwargs):
+        self.clock = task.Clock()
+        self.patch(changes, 'reactor', self.clock)
+        source = changes.createChangeSource(**kwargs)
+        source.parent = self.changemaster
+        return source
+
+
+class Polling(ChangeSourceMixin, unittest.TestCase):
+    def recordPages(self, source):
+        '''Record the limit and the number of pushes of each page.
+        '''
+        pages = []
+        pollPage = source.pollPage
+
+        def recordPage(limit):
+            count = pollPage(limit)
+            pages.append((limit, count))
+            return count
+        source.pollPage = recordPage
+        return pages
+
+    def nextPoll(self, source):
+        return source.dPoll.getTime() - self.clock.seconds()
+
+    def test_paging(self):
+        pushes = self.createPushes('polling', [['file']] * 5)
+        source = self.changeSource()
+        source.latest = pushes[0].id - 1
+        source.pageSize = 2
+        source.maxPushes = 3
+        pages = self.recordPages(source)
+        source.startService()
+        self.clock.advance(0)
+        # a poll stops after maxPushes, in pages of at most pageSize
+        self.failUnlessEqual(pages, [(2, 2), (1, 1)])
+        self.failUnlessEqual(source.latest, pushes[2].id)
+        self.failUnlessEqual(len(self.changemaster.changes), 3)
+        # and the next one comes soon, to catch up
+        self.failUnlessEqual(self.nextPoll(source), 1)
+        del pages[:]
+        self.clock.advance(1)
+        self.failUnlessEqual(pages, [(2, 2), (1, 0)])
+        self.failUnlessEqual(source.latest, pushes[-1].id)
+        self.failUnlessEqual(
+            [c.revision for c in self.changemaster.changes],
+            [str(p.changesets.get().revision) for p in pushes])
+        # idle polls back off
+        self.clock.advance(1)
+        self.failUnlessEqual(self.nextPoll(source), 2)
+        self.clock.advance(2)
+        self.failUnlessEqual(self.nextPoll(source), 4)
+        # until there's a push again
+        self.createPushes('polling', [['file']])
+        self.clock.advance(4)
+        self.failUnlessEqual(len(self.changemaster.changes), 6)
+        self.failUnlessEqual(self.nextPoll(source), 1)
+        return source.stopService()
+
+    def test_notify(self):
+        pushes = self.createPushes('notify', [['file']])
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        path = os.path.join(basedir, 'pushes.sock')
+        source = self.changeSource(notifySocket=path)
+        source.latest = pushes[-1].id
+        # the socket is real, the polls go by the fake clock
+        self.clock.listenUNIX = reactor.listenUNIX
+        notified = defer.Deferred()
+        notify = source.notify
+
+        def onNotify():
+            notify()
+            notified.callback(None)
+        source.notify = onNotify
+        source.startService()
+        self.clock.advance(0)
+        self.clock.advance(2)
+        self.failUnlessEqual(self.nextPoll(source), 4)
+        pushes = self.createPushes('notify', [['file']])
+        changes.notifyPushes(path)
+
+        def check(_):
+            # the notification polls right away
+            self.failUnlessEqual(self.nextPoll(source), 0)
+            self.clock.advance(0)
+            self.failUnlessEqual(
+                [c.revision for c in self.changemaster.changes],
+                [str(pushes[0].changesets.get().revision)])
+            # and the backoff starts over
+            self.failUnlessEqual(self.nextPoll(source), 1)
+            return source.stopService()
+        notified.addCallback(check)
+        return notified
+
+
+class Interests(ChangeSourceMixin, unittest.TestCase):
+    def test_skippedLast(self):
+        from life.models import Forest
+        wanted = self.createPushes('interests-app', [['a']])
+        locale = self.createPushes('interests-l10n/de', [['b']])
+        other = self.createPushes('interests-other', [['c'], ['d']])
+        forest, _ = Forest.objects.get_or_create(name='interests-l10n')
+        locale[0].repository.forest = forest
+        locale[0].repository.save()
+        self.changemaster.parent.schedulers = [
+            FakeScheduler(['interests-app'], ['interests-l10n'])]
+        source = self.changeSource()
+        source.latest = wanted[0].id - 1
+        self.failUnlessEqual(source.pollPage(10), 4)
+        self.failUnlessEqual(
+            [(c.branch, c.files) for c in self.changemaster.changes],
+            [('interests-app', ['a']), ('interests-l10n', ['b'])])
+        # the pushes nobody needs end the window, and are passed, too
+        self.failUnlessEqual(source.latest, other[-1].id)
+        self.failUnlessEqual(source.pollPage(10), 0)
+
+    def test_staleTips(self):
+        wanted = self.createPushes('interests-wanted', [['a']])
+        self.createPushes('interests-other', [['b']])
+        self.changemaster.parent.schedulers = [
+            FakeScheduler(['interests-wanted'])]
+        tips.cache.update('interests-other', 0, datetime(2000, 1, 1), 'old')
+        source = self.changeSource()
+        source.latest = wanted[0].id - 1
+        self.failUnlessEqual(source.pollPage(10), 2)
+        self.failUnlessEqual([c.branch for c in self.changemaster.changes],
+                             ['interests-wanted'])
+        self.failUnless(tips.cache.get('interests-wanted'))
+        # the skipped push isn't in the cache, and neither is its old tip
+        self.failIf(tips.cache.get('interests-other'))
+
+
+class Replay(ChangeSourceMixin, unittest.TestCase):
+    def test_replay(self):
+        pushes = self.createPushes('replay', [['file']] * 5)
+        checkpoint = self.mktemp()
+        source = self.changeSource()
+        source.pageSize = 2
+        builder = self.changemaster.parent.botmaster.builders['compare']
+        source.replay('compare', startPush=pushes[0].id, inflight=2,
+                      checkpoint=checkpoint)
+        self.failUnlessEqual(len(builder.buildable), 2)
+        with open(checkpoint) as f:
+            self.failUnlessEqual(f.read(), str(pushes[1].id))
+        # a restarted replay continues after the checkpoint
+        del builder.buildable[:]
+        d = self.changeSource().replay('compare', inflight=2,
+                                       checkpoint=checkpoint)
+        self.failUnlessEqual(len(builder.buildable), 2)
+        del builder.buildable[:]
+        self.clock.advance(1)
+        self.failUnlessEqual(
+            [c.revision for c in self.changemaster.changes],
+            [str(p.changesets.get().revision) for p in pushes])
+        with open(checkpoint) as f:
+            self.failUnlessEqual(f.read(), str(pushes[-1].id))
+        d.addCallback(self.failUnlessEqual, 3)
+        return d
+
+
+class CollapseBacklog(ChangeSourceMixin, unittest.TestCase):
+    def test_collapse(self):
+        app = self.createPushes('collapse-app', [['a'], ['b', 'common']])
+        source = self.changeSource(collapseBacklog=True)
+        source.latest = app[0].id - 1
+        source.pageSize = 2
+        # pushes that land before the service starts are collapsed, too
+        app += self.createPushes('collapse-app', [['common', 'c']])
+        other = self.createPushes('collapse-other', [['d']])
+        source.startService()
+        self.failUnlessEqual(source.catchUpTo, other[-1].id)
+        self.failUnlessEqual(source.pollPage(2), 2)
+        self.failIf(self.changemaster.changes)
+        self.failUnlessEqual(source.pollPage(2), 2)
+        self.failUnlessEqual(source.catchUpTo, None)
+        self.failUnlessEqual(
+            [(c.branch, c.files, c.revision)
+             for c in self.changemaster.changes],
+            [('collapse-app', ['a', 'b', 'c', 'common'],
+              str(app[-1].changesets.get().revision)),
+             ('collapse-other', ['d'],
+              str(other[-1].changesets.get().revision))])
+        # after catching up, each push is a change again
+        more = self.createPushes('collapse-other', [['e'], ['f']])
+        self.failUnlessEqual(source.pollPage(2), 2)
+        self.failUnlessEqual([c.files for c in self.changemaster.changes[2:]],
+                             [['e'], ['f']])
+        self.failUnlessEqual(source.latest, more[-1].id)
+        return source.stopService()
+
+
+class Recovery(ChangeSourceMixin, unittest.TestCase):
+    start = datetime(2020, 1, 1, 12)
+
+    def createDebris(self, push, count):
+        '''Create count builds for push that didn't finish, with
+        one finished and one running step each.
+        '''
+        from mbdb.models import (Build, Builder, Change, Master,
+                                 SourceStamp, Step)
+        master, _ = Master.objects.get_or_create(name='recovery')
+        builder, _ = Builder.objects.get_or_create(name='compare',
+                                                   master=master)
+        builds = []
+        for i in xrange(count):
+            change = Change.objects.create(
+                number=i, who='jane', comments='', when=self.start,
+                revision=push.changesets.get().revision)
+            stamp = SourceStamp.objects.create()
+            stamp.changes.add(change)
+            build = Build.objects.create(builder=builder,
+                                         buildnumber=Build.objects.count(),
+                                         sourcestamp=stamp,
+                                         starttime=self.start)
+            Step.objects.create(build=build, name='update',
+                                starttime=self.start,
+                                endtime=self.start + timedelta(minutes=1))
+            Step.objects.create(build=build, name='compare',
+                                starttime=self.start + timedelta(minutes=1))
+            builds.append(build.id)
+        return builds
+
+    def recover(self):
+        with CaptureQueriesContext(connection) as queries:
+            latest = changes.get_last_push_and_clean_up()
+        return latest, len(queries)
+
+    def test_cleanUp(self):
+        from mbdb.models import Build, Step
+        pushes = self.createPushes('recovery', [['a'], ['b']])
+        builds = self.createDebris(pushes[0], 1)
+        latest, few = self.recover()
+        self.failUnlessEqual(latest, pushes[0].id - 1)
+        builds += self.createDebris(pushes[0], 3)
+        latest, many = self.recover()
+        self.failUnlessEqual(latest, pushes[0].id - 1)
+        # the builds and steps are updated in bulk
+        self.failUnlessEqual(few, many)
+        for build in Build.objects.filter(id__in=builds):
+            self.failUnlessEqual(build.endtime,
+                                 self.start + timedelta(minutes=1))
+            self.failUnlessEqual(build.result, EXCEPTION)
+        steps = Step.objects.filter(build__in=builds, name='compare')
+        self.failUnlessEqual(steps.count(), len(builds))
+        for step in steps:
+            self.failUnlessEqual(step.endtime, step.starttime)
+            self.failUnlessEqual(step.result, EXCEPTION)
+
+    def test_noDebris(self):
+        pushes = self.createPushes('recovery-clean', [['a'], ['b']])
+        latest, queries = self.recover()
+        # no runs, restart after the latest push
+        self.failUnlessEqual(latest, pushes[-1].id)
+        # the unfinished builds, the changes to redo, the recent push ids
+        # and their tips
+        self.failUnlessEqual(queries, 4)
@@ -196,3 +196,29 @@ dirs = android/base
                       None,
                       dict(warnings=1, completion=100, total=3))
         return d
+
+
+class ForLocale(unittest.TestCase):
+    basedir = 'test_compare.testForLocale'
+    locales = ('good', 'obsolete', 'missing', 'errors')
+
+    def setUp(self):
+        createStage(self.basedir, *SlaveSide.stageFiles)
+        self.command = InspectCommand(None, 'compare', {
+            'inipath': 'mozilla/app/locales/l10n.ini',
+            'l10nbase': 'l10n',
+            'redirects': {}})
+
+    def test_split(self):
+        workingdir = os.path.abspath(self.basedir)
+        batched = self.command._compare(workingdir, list(self.locales), None)
+        for locale in self.locales:
+            # the batched results for a locale are the same as comparing
+            # just that locale
+            single = self.command._compare(workingdir, [locale], None)
+            self.assertEquals(len(batched), len(single))
+            for observer, expected in zip(batched, single):
+                observer = self.command.forLocale(observer, locale)
+                self.assertEquals(observer.toJSON(), expected.toJSON())
+                self.assertEquals(observer.serialize(), expected.serialize())
+                self.assertEquals(observer.file_stats, expected.file_stats)
@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import http, resource, server
+
+import os
+
+from l10ninsp import httpcache
+
+
+class Page(resource.Resource):
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.body = 'de\nfr\n'
+        self.etag = '"1"'
+        self.requests = []
+
+    def render_GET(self, request):
+        cached = request.setETag(self.etag)
+        self.requests.append(request.code)
+        if cached == http.CACHED:
+            return ''
+        return self.body
+
+
+class PageCache(unittest.TestCase):
+    def setUp(self):
+        self.page = Page()
+        self.port = reactor.listenTCP(0, server.Site(self.page),
+                                      interface='127.0.0.1')
+        self.url = ('http://127.0.0.1:%d/all-locales' %
+                    self.port.getHost().port)
+        self.cache = httpcache.PageCache(self.mktemp())
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_revalidate(self):
+        page = yield self.cache.getPage(self.url)
+        self.failUnlessEqual(page, 'de\nfr\n')
+        page = yield self.cache.getPage(self.url)
+        self.failUnlessEqual(page, 'de\nfr\n')
+        self.failUnlessEqual(self.page.requests, [200, 304])
+        # a new master starts with the cache on disk
+        cache = httpcache.PageCache(self.cache.cachedir)
+        self.page.body = 'de\nfr\nit\n'
+        self.page.etag = '"2"'
+        page = yield cache.getPage(self.url)
+        self.failUnlessEqual(page, 'de\nfr\nit\n')
+        self.failUnlessEqual(self.page.requests, [200, 304, 200])
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        pages = yield defer.gatherResults([self.cache.getPage(self.url),
+                                           self.cache.getPage(self.url)])
+        self.failUnlessEqual(pages, ['de\nfr\n'] * 2)
+        self.failUnlessEqual(self.page.requests, [200])
+        self.failIf(self.cache.inflight)
+
+    def test_failedStart(self):
+        def deferToThread(f, *args, **kwargs):
+            raise RuntimeError('no threads')
+        self.patch(httpcache.threads, 'deferToThread', deferToThread)
+        d = self.cache.getPage(self.url)
+        self.failIf(self.cache.inflight)
+        return self.assertFailure(d, RuntimeError)
+
+    def test_prune(self):
+        cache = httpcache.PageCache(self.mktemp(), maxEntries=2)
+        for i in xrange(3):
+            url = self.url + '?%d' % i
+            cache.store(url, {'etag': '"%d"' % i}, 'page %d' % i)
+            # make the first entry the oldest one
+            os.utime(cache.path(url) + '.json', (i, i))
+        cache.prune()
+        self.failUnlessEqual(cache.load(self.url + '?0'), None)
+        self.failUnlessEqual(cache.load(self.url + '?2')['body'], 'page 2')
+        self.failUnlessEqual(len(os.listdir(cache.cachedir)), 4)
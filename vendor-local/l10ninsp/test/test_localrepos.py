@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from distutils.spawn import find_executable
+import os
+import subprocess
+
+from l10ninsp import localrepos
+
+
+class LocalFiles(unittest.TestCase):
+    def setUp(self):
+        self.urls = []
+
+        def getPage(url, **kwargs):
+            self.urls.append(url)
+            return defer.succeed('from http')
+        self.patch(localrepos.httpcache.cache, 'getPage', getPage)
+        self.base = self.mktemp()
+        os.makedirs(self.base)
+        self.files = localrepos.LocalFiles(self.base)
+
+    @defer.inlineCallbacks
+    def test_noClone(self):
+        content = yield self.files.getFile('http://localhost', 'central',
+                                           'abcdef', 'app/l10n.ini')
+        self.failUnlessEqual(content, 'from http')
+        self.failUnlessEqual(self.urls,
+                             ['http://localhost/central/raw-file/abcdef/'
+                              'app/l10n.ini'])
+
+    @defer.inlineCallbacks
+    def test_clone(self):
+        clone = os.path.join(self.base, 'central')
+        subprocess.check_call(['hg', 'init', clone])
+        os.makedirs(os.path.join(clone, 'app'))
+        with open(os.path.join(clone, 'app', 'all-locales'), 'w') as f:
+            f.write('de\n')
+        subprocess.check_call(['hg', 'commit', '-q', '-A', '-m', 'first',
+                               '-u', 'test'], cwd=clone)
+        with open(os.path.join(clone, 'app', 'all-locales'), 'w') as f:
+            f.write('de\nfr\n')
+        subprocess.check_call(['hg', 'commit', '-q', '-m', 'second',
+                               '-u', 'test'], cwd=clone)
+        content = yield self.files.getFile('http://localhost', 'central',
+                                           '0', 'app/all-locales')
+        self.failUnlessEqual(content, 'de\n')
+        content = yield self.files.getFile('http://localhost', 'central',
+                                           'default', 'app/all-locales')
+        self.failUnlessEqual(content, 'de\nfr\n')
+        self.failIf(self.urls)
+        # unknown revisions are loaded over http
+        content = yield self.files.getFile('http://localhost', 'central',
+                                           'abcdef', 'app/all-locales')
+        self.failUnlessEqual(content, 'from http')
+    if find_executable('hg') is None:
+        test_clone.skip = 'needs hg'
+
+    def test_relativePath(self):
+        from life.models import Repository
+        self.patch(Repository, 'relative_path',
+                   lambda repo: 'archive/' + repo.name)
+        Repository.objects.create(name='releases/central',
+                                  url='http://localhost/releases/central')
+        os.makedirs(os.path.join(self.base, 'archive', 'releases',
+                                 'central', '.hg'))
+        self.failUnlessEqual(self.files.clone('releases/central'),
+                             os.path.join(self.base, 'archive', 'releases',
+                                          'central'))
+        # repositories that aren't in the database use their name
+        self.failUnlessEqual(self.files.clone('archive/releases/central'),
+                             os.path.join(self.base, 'archive', 'releases',
+                                          'central'))
+        self.failUnlessEqual(self.files.clone('central'), None)
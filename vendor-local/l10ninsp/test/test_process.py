@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from buildbot.changes.changes import Change
+from buildbot.process.base import BuildRequest
+from buildbot.process.properties import Properties
+from buildbot.sourcestamp import SourceStamp
+from twisted.trial import unittest
+
+import time
+
+from l10ninsp import process
+
+
+class FakeBuilder:
+    name = 'compare'
+
+
+def request(submitted, changes=None, **props):
+    properties = Properties()
+    properties.update(props, 'Scheduler')
+    req = BuildRequest('test', SourceStamp(changes=changes or []),
+                       'compare', properties=properties)
+    req.submittedAt = submitted
+    return req
+
+
+class NextBuild(unittest.TestCase):
+    def test_priority(self):
+        now = time.time()
+        tree = request(now - 10, priority='tree')
+        en_US = request(now - 5, priority='en-US')
+        locale = request(now, priority='locale')
+        requests = [tree, en_US, locale]
+        self.failUnless(process.nextBuild(None, requests) is locale)
+        requests.remove(locale)
+        self.failUnless(process.nextBuild(None, requests) is en_US)
+
+    def test_aging(self):
+        now = time.time()
+        old = request(now - 3 * process.AGING, priority='en-US')
+        locale = request(now, priority='locale')
+        unknown = request(now - 10)
+        requests = [locale, old, unknown]
+        self.failUnless(process.nextBuild(None, requests) is old)
+        requests.remove(old)
+        self.failUnless(process.nextBuild(None, requests) is locale)
+
+
+class MergeRequests(unittest.TestCase):
+    def setUp(self):
+        self.changes = [Change('author', ['file'], 'comment', when=i)
+                        for i in xrange(3)]
+
+    def test_sameLocale(self):
+        old = request(1, [self.changes[0]], tree='fx', locale='de',
+                      l10n_revision='old', srctime=1)
+        new = request(2, [self.changes[1]], tree='fx', locale='de',
+                      l10n_revision='new', srctime=2)
+        self.failUnless(process.mergeRequests(FakeBuilder(), old, new))
+        self.failUnless(process.mergeRequests(FakeBuilder(), new, old))
+
+    def test_otherLocale(self):
+        de = request(1, [self.changes[0]], tree='fx', locale='de')
+        fr = request(2, [self.changes[1]], tree='fx', locale='fr')
+        tb = request(3, [self.changes[2]], tree='tb', locale='de')
+        self.failIf(process.mergeRequests(FakeBuilder(), de, fr))
+        self.failIf(process.mergeRequests(FakeBuilder(), de, tb))
+
+    def test_batchLocales(self):
+        props = {'tree': 'fx', 'revisions': ['en', 'l10n'],
+                 'en_branch': 'central', 'en_revision': 'abc',
+                 'l10n_branch': 'l10n'}
+        de = request(1, [self.changes[0]], locale='de', **props)
+        fr = request(2, [self.changes[1]], locale='fr', **props)
+        props['en_revision'] = 'def'
+        it = request(3, [self.changes[2]], locale='it', **props)
+        self.failUnless(process.mergeRequests(FakeBuilder(), de, fr))
+        # different en-US revisions are compared separately
+        self.failIf(process.mergeRequests(FakeBuilder(), de, it))
+        self.failIf(process.mergeRequests(FakeBuilder(), fr, it))
+
+    def test_batchLimit(self):
+        self.patch(process, 'BATCH_LOCALES', 2)
+        props = {'tree': 'fx', 'revisions': ['en', 'l10n'],
+                 'en_branch': 'central', 'en_revision': 'abc'}
+        de, fr, it = (request(i, [self.changes[i]], locale=loc, **props)
+                      for i, loc in enumerate(('de', 'fr', 'it')))
+        self.failUnless(process.mergeRequests(FakeBuilder(), de, fr))
+        self.failIf(process.mergeRequests(FakeBuilder(), de, it))
+        # a newer request for a locale in the batch still merges
+        fr2 = request(4, [self.changes[2]], locale='fr', **props)
+        self.failUnless(process.mergeRequests(FakeBuilder(), de, fr2))
+
+    def test_batchNoL10n(self):
+        # locales without a repository don't have an l10n revision
+        props = {'tree': 'fx', 'revisions': ['en'],
+                 'en_branch': 'central', 'en_revision': 'abc'}
+        de = request(1, [self.changes[0]], locale='de', **props)
+        fr = request(2, [self.changes[1]], locale='fr', **props)
+        self.failIf(process.mergeRequests(FakeBuilder(), de, fr))
+
+    def test_batchRevisions(self):
+        props = {'tree': 'fx', 'revisions': ['en', 'l10n'],
+                 'en_branch': 'central', 'en_revision': 'abc'}
+        de, fr = (request(i, [self.changes[i]], locale=loc,
+                          l10n_revision=loc, **props)
+                  for i, loc in enumerate(('de', 'fr')))
+        props['en_revision'] = 'def'
+        de2 = request(2, [self.changes[2]], locale='de',
+                      l10n_revision='de2', **props)
+        # a batch only takes requests at its en-US revisions
+        self.failUnless(process.mergeRequests(FakeBuilder(), fr, de))
+        self.failIf(process.mergeRequests(FakeBuilder(), fr, de2))
+        # and locales only batch if all merged requests agree
+        self.failUnless(process.mergeRequests(FakeBuilder(), de, de2))
+        self.failIf(process.mergeRequests(FakeBuilder(), de, fr))
+
+    def test_noChanges(self):
+        # sourcestamps without changes can't merge with ones with changes
+        de = request(1, [self.changes[0]], tree='fx', locale='de')
+        rebuild = request(2, tree='fx', locale='de')
+        self.failIf(process.mergeRequests(FakeBuilder(), de, rebuild))
+
+    def test_trees(self):
+        # tree builds don't have a locale
+        a = request(1, tree='fx', l10nbuilds='l10nbuilds.ini')
+        b = request(2, tree='fx', l10nbuilds='l10nbuilds.ini')
+        c = request(3, tree='tb', l10nbuilds='l10nbuilds.ini')
+        self.failUnless(process.mergeRequests(FakeBuilder(), a, b))
+        self.failIf(process.mergeRequests(FakeBuilder(), a, c))
+
+
+class Factory(unittest.TestCase):
+    def test_newest(self):
+        changes = [Change('author', ['file'], 'comment', when=i)
+                   for i in xrange(2)]
+        props = {'tree': 'fx', 'locale': 'de',
+                 'revisions': ['en', 'l10n']}
+        old = request(1, changes[:1], l10n_revision='old', **props)
+        new = request(2, changes, l10n_revision='new', **props)
+        f = process.Factory('/base', 'test-master')
+        b = f.newBuild([new, old])
+        self.failUnless(b.requests[-1] is new)
+        self.failUnlessEqual(list(b.source.changes), changes)
+
+    def test_batch(self):
+        changes = [Change('author', ['file'], 'comment', when=i)
+                   for i in xrange(3)]
+        props = {'tree': 'fx', 'revisions': ['en', 'l10n'],
+                 'en_branch': 'central', 'en_revision': 'abc'}
+        de = request(1, changes[:1], locale='de', l10n_branch='l10n/de',
+                     l10n_revision='de1', srctime=1, **props)
+        fr = request(2, changes[1:2], locale='fr', l10n_branch='l10n/fr',
+                     l10n_revision='fr1', srctime=2, **props)
+        de2 = request(3, changes[2:], locale='de', l10n_branch='l10n/de',
+                      l10n_revision='de2', srctime=3, **props)
+        f = process.Factory('/base', 'test-master')
+        b = f.newBuild([fr, de2, de])
+        self.failUnless(b.requests[-1] is de2)
+        inspect = b.stepFactories[-1][1]
+        self.failUnlessEqual(inspect['locales'],
+                             [('de', 'de2', 3), ('fr', 'fr1', 2)])
+        # fr is updated explicitly, de by the build properties
+        updates = [kwargs['workdir'] for cls, kwargs in b.stepFactories
+                   if 'update' in kwargs.get('command', [])]
+        self.failUnlessEqual(updates[-1], '/base/l10n/fr')
+        self.failUnlessEqual(len(updates), 3)
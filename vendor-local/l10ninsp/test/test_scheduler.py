@@ -9,7 +9,16 @@ from twisted.application import service
 from twisted.internet import reactor, defer
 from twisted.spread import pb
 
-from l10ninsp import scheduler
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import hashlib
+import os
+import random
+import time
+
+from l10ninsp import scheduler, tips
 import l10ninsp.logger
 l10ninsp.logger.init(
     scheduler=l10ninsp.logger.DEBUG
@@ -19,9 +28,12 @@ l10ninsp.logger.init(
 # copied from buildbot.test.test_scheduler
 class FakeMaster(service.MultiService):
     d = None
+    builder = None
 
     def submitBuildSet(self, bs):
         self.sets.append(bs)
+        if self.builder is not None:
+            bs.start([self.builder])
         if self.d:
             reactor.callLater(0, self.d.callback, bs)
             self.d = None
@@ -38,24 +50,77 @@ class FakeBuilder:
         self.requests.append(req)
 
 
+class QueueBuilder(FakeBuilder):
+    def __init__(self, name):
+        FakeBuilder.__init__(self, name)
+        # the queued requests and the builds, like buildbot's Builder
+        self.buildable = self.requests
+        self.building = []
+
+    def submitBuildRequest(self, req):
+        FakeBuilder.submitBuildRequest(self, req)
+        req.requestSubmitted(self)
+
+    def cancelBuildRequest(self, req):
+        if req in self.requests:
+            self.requests.remove(req)
+            return True
+        return False
+
+    def pickBuild(self, req):
+        '''Take the request off the queue, while the slave
+        isn't told about the build yet.
+        '''
+        self.requests.remove(req)
+        build = FakeBuild([req])
+        self.building.append(build)
+        return build
+
+    def startBuild(self, req):
+        build = self.pickBuild(req)
+        build.currentStep = 'compare'
+        req.buildStarted(build, builderstatus.BuildStatus(
+            builderstatus.BuilderStatus(self.name), 1))
+        return build
+
+
+class FakeBuild:
+    finished = False
+    currentStep = None
+
+    def __init__(self, requests=()):
+        self.requests = list(requests)
+        self.properties = {}
+        self.stopped = None
+
+    def setProperty(self, name, value, source):
+        self.properties[name] = value
+
+    def stopBuild(self, reason):
+        self.stopped = reason
+
+
 class AppScheduler(unittest.TestCase):
     def setUp(self):
         self.master = master = FakeMaster()
         master.sets = []
         master.startService()
+        tips.cache.clear()
 
     def tearDown(self):
         d = self.master.stopService()
         return d
 
-    def addScheduler(self, name, builderNames, inipath, treebuildername):
+    def addScheduler(self, name, builderNames, inipath, treebuildername,
+                     **kwargs):
         s = scheduler.AppScheduler(
-            name, builderNames, inipath, treebuildername)
+            name, builderNames, inipath, treebuildername, **kwargs)
         s.setServiceParent(self.master)
         self.scheduler = s
 
-    def setupSimple(self):
-        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+    def setupSimple(self, **kwargs):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds',
+                          **kwargs)
         t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
                            'l10n-test', 'test-app/locales/l10n.ini')
         t.addData('test-branch', 'test-app/locales/l10n.ini',
@@ -131,3 +196,658 @@ class AppScheduler(unittest.TestCase):
         self.failUnlessEqual(len(pendings), 2)
         self.failUnlessEqual(len(pendings[('test', 'de')]), 1)
         self.failUnlessEqual(len(pendings[('test', 'fr')]), 1)
+
+    def test_e_treeUpdate(self):
+        self.setupSimple()
+        t = scheduler.Tree('other', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'other-app/locales/l10n.ini')
+        t.addData('test-branch', 'other-app/locales/l10n.ini',
+                  ['other-app', 'shared'])
+        self.scheduler.addTree(t)
+        branchdata = self.scheduler.branches['test-branch']
+        self.failUnlessEqual(branchdata.dirs['shared'], set(['other']))
+        # update 'test' to use 'shared', too, and drop 'test-app'
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['shared'], tld='test-app')
+        self.scheduler.addTree(t)
+        self.failUnless('test-app' not in branchdata.dirs)
+        self.failUnlessEqual(branchdata.dirs['shared'],
+                             set(['test', 'other']))
+        self.failUnlessEqual(branchdata.topleveltrees, set(['test']))
+        l10ndirs = self.scheduler.l10nbranches['l10n-test']
+        self.failUnlessEqual(l10ndirs['test-app'], set(['test']))
+        self.failUnless('other-app' in l10ndirs)
+        # move 'other' to a different l10n forest
+        t = scheduler.Tree('other', 'http://localhost/', 'other-branch',
+                           'l10n-other', 'other-app/locales/l10n.ini')
+        t.addData('other-branch', 'other-app/locales/l10n.ini',
+                  ['other-app'])
+        self.scheduler.addTree(t)
+        self.failUnlessEqual(branchdata.dirs['shared'], set(['test']))
+        self.failUnless('other-app/locales/l10n.ini' not in branchdata.inis)
+        self.failUnless('other-app' not in l10ndirs)
+        self.failUnlessEqual(
+            self.scheduler.l10nbranches['l10n-other']['other-app'],
+            set(['other']))
+        self.failUnlessEqual(
+            self.scheduler.branches['other-branch'].dirs['other-app'],
+            set(['other']))
+
+    def test_f_allLocales(self):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+        t = scheduler.Tree('other', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'other-app/locales/l10n.ini')
+        t.addData('test-branch', 'other-app/locales/l10n.ini',
+                  ['other-app'])
+        t.all_locales = 'other-app/locales/all-locales'
+        t.locales += ['de']
+        self.scheduler.addTree(t)
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['test-app'])
+        t.all_locales = 'test-app/locales/all-locales'
+        t.locales += ['de', 'fr']
+        self.scheduler.addTree(t)
+        pages = {
+            'test-app': defer.Deferred(),
+            'other-app': defer.Deferred(),
+        }
+
+        def getPage(url, **kwargs):
+            return pages[url.split('/')[-3]]
+        self.patch(scheduler.localrepos.httpcache.cache, 'getPage', getPage)
+        c = Change('author', ['test-app/locales/all-locales',
+                              'other-app/locales/all-locales'], 'comment',
+                   branch='test-branch', revision='abcdef')
+        c.number = 1
+        self.scheduler.addChange(c)
+        self.failIf(self.scheduler.pendings)
+        pages['other-app'].errback(Exception('not found'))
+        self.failIf(self.scheduler.pendings)
+        pages['test-app'].callback('de\nfr\nit\n')
+        self.failUnlessEqual(self.scheduler.pendings.keys(),
+                             [('test', 'it')])
+        self.failUnlessEqual(self.scheduler.trees['test'].locales,
+                             ['de', 'fr', 'it'])
+        self.failUnlessEqual(self.scheduler.trees['other'].locales, ['de'])
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def createPushes(self, locales):
+        from life.models import (Branch, Changeset, Forest, Push,
+                                 Repository)
+        default, _ = Branch.objects.get_or_create(name='default')
+        forest, _ = Forest.objects.get_or_create(name='l10n-test')
+        for name in ['test-branch'] + ['l10n-test/' + l for l in locales]:
+            repo, created = Repository.objects.get_or_create(
+                name=name,
+                defaults={'url': 'http://localhost/' + name})
+            if not created:
+                continue
+            if name.startswith('l10n-test/'):
+                repo.forest = forest
+                repo.save()
+            cs = Changeset.objects.create(
+                revision=hashlib.sha1(name).hexdigest(), branch=default)
+            repo.changesets.add(cs)
+            push = Push.objects.create(repository=repo, user='jane',
+                                       push_date=datetime.utcnow(),
+                                       push_id=1)
+            push.changesets.add(cs)
+
+    def submitForLocales(self, locales, when=None):
+        self.createPushes(locales)
+        self.scheduler.trees['test'].locales = locales
+        for l in locales:
+            changes = []
+            if when is not None:
+                changes.append(Change('author', ['test-app/file.dtd'],
+                                      'comment', branch='l10n-test',
+                                      when=when))
+            self.scheduler.compareBuild('test', l, changes)
+        self.scheduler.dSubmitBuildsets.cancel()
+        del self.master.sets[:]
+        with CaptureQueriesContext(connection) as queries:
+            self.scheduler.submitBuildsets()
+        self.failUnlessEqual(len(self.master.sets), len(locales))
+        return len(queries)
+
+    def test_g_queryCount(self):
+        self.setupSimple()
+        few = self.submitForLocales(['de', 'fr'])
+        many = self.submitForLocales(['de', 'fr', 'it', 'ja', 'pl', 'sv'])
+        self.failUnlessEqual(few, many)
+        props = self.master.sets[0].properties
+        self.failUnlessEqual(props['revisions'], ['en', 'l10n'])
+        self.failUnlessEqual(len(props['l10n_revision']), 40)
+        # changes older than the latest pushes need older revisions,
+        # those are loaded in bulk, too
+        when = time.time() - 3600
+        few = self.submitForLocales(['de', 'fr'], when=when)
+        many = self.submitForLocales(['de', 'fr', 'it', 'ja', 'pl', 'sv'],
+                                     when=when)
+        self.failUnlessEqual(few, many)
+        props = self.master.sets[0].properties
+        self.failUnlessEqual(props['srctime'], scheduler.timeHelper(when))
+        self.failUnlessEqual(len(props['l10n_revision']), 40)
+
+    def test_g_noChangeTime(self):
+        # without a change time, the en-US push bounds the l10n revision
+        from life.models import Push
+        self.setupSimple()
+        self.createPushes(['de'])
+        now = datetime.utcnow()
+        Push.objects.filter(repository__name='test-branch').update(
+            push_date=now - timedelta(hours=1))
+        Push.objects.filter(repository__name='l10n-test/de').update(
+            push_date=now - timedelta(hours=2))
+        self.createPush('l10n-test/de')
+        self.scheduler.compareBuild('test', 'de', [])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        props = self.master.sets[0].properties
+        self.failUnlessEqual(props['l10n_revision'],
+                             hashlib.sha1('l10n-test/de').hexdigest())
+        self.failUnlessEqual(
+            props['srctime'],
+            Push.objects.get(repository__name='test-branch').push_date)
+
+    def test_h_tipCache(self):
+        self.setupSimple()
+        cold = self.submitForLocales(['de', 'fr'])
+        self.failUnless(tips.cache.get('l10n-test/de'))
+        warm = self.submitForLocales(['de', 'fr'])
+        self.failUnless(warm < cold)
+        # pushes newer than the change time don't come from the cache
+        push_id, push_date, revision = tips.cache.get('l10n-test/de')
+        tips.cache.update('l10n-test/de', push_id + 1,
+                          datetime(2100, 1, 1), 'f' * 40)
+        self.scheduler.compareBuild(
+            'test', 'de', [Change('author', ['test-app/file.dtd'], 'comment',
+                                  branch='l10n-test', when=1500000000)])
+        self.scheduler.dSubmitBuildsets.cancel()
+        del self.master.sets[:]
+        self.scheduler.submitBuildsets()
+        props = self.master.sets[0].properties
+        self.failIfEqual(props['l10n_revision'], 'f' * 40)
+
+    def test_i_coalesce(self):
+        self.setupSimple(delay=10, maxWait=30)
+
+        def change(n):
+            c = Change('author', ['test-app/file.dtd'], 'comment',
+                       branch='l10n-test', properties={'locale': 'de'})
+            c.number = n
+            return c
+        self.scheduler.addChange(change(1))
+        call = self.scheduler.dSubmitBuildsets
+        first = call.getTime()
+        self.failUnless(first > time.time() + 5)
+        self.scheduler.addChange(change(2))
+        self.failUnless(self.scheduler.dSubmitBuildsets is call)
+        self.failUnless(call.getTime() >= first)
+        # past maxWait, submit right away
+        self.scheduler.firstPending -= 30
+        self.scheduler.addChange(change(3))
+        self.failUnless(call.getTime() <= time.time())
+        call.cancel()
+        pendings = self.scheduler.pendings
+        self.failUnlessEqual(len(pendings), 1)
+        self.failUnlessEqual([c.number for c in pendings[('test', 'de')]],
+                             [1, 2, 3])
+        self.failUnlessEqual(self.scheduler.coalesced, 2)
+
+    def test_j_priority(self):
+        self.setupSimple()
+        c = Change('author', ['test-app/locales/en-US/file.dtd'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        self.scheduler.addChange(c)
+        priorities = self.scheduler.priorities
+        self.failUnlessEqual(priorities, {('test', 'de'): 'en-US',
+                                          ('test', 'fr'): 'en-US'})
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'de'})
+        c.number = 2
+        self.scheduler.addChange(c)
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.failUnlessEqual(priorities, {('test', 'de'): 'locale',
+                                          ('test', 'fr'): 'en-US'})
+
+    def test_k_gating(self):
+        self.setupSimple()
+        t = scheduler.Tree('other', 'http://localhost/', 'other-branch',
+                           'l10n-other', 'other-app/locales/l10n.ini')
+        t.addData('other-branch', 'other-app/locales/l10n.ini',
+                  ['other-app'])
+        t.locales += ['de']
+        self.scheduler.addTree(t)
+        c = Change('author', ['test-app/locales/l10n.ini'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        self.scheduler.addChange(c)
+        self.failUnlessEqual(len(self.master.sets), 1)
+        self.failUnlessEqual(sorted(self.scheduler.gatedBranches),
+                             ['l10n-test', 'test-branch'])
+        # locale pushes on other forests are scheduled right away
+        c = Change('author', ['other-app/file.dtd'], 'comment',
+                   branch='l10n-other', properties={'locale': 'de'})
+        c.number = 2
+        self.scheduler.addChange(c)
+        pendings = self.scheduler.pendings
+        self.failUnlessEqual(pendings.keys(), [('other', 'de')])
+        # locale pushes on the reloading forest wait
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'fr'})
+        c.number = 3
+        self.scheduler.addChange(c)
+        self.failUnlessEqual(len(pendings), 1)
+        self.failUnlessEqual([_c.number for _c in
+                              self.scheduler.pendingChanges], [3])
+        bset = self.master.sets[0]
+        ftb = FakeBuilder('tree-builds')
+        bset.start([ftb])
+        builder = builderstatus.BuilderStatus('tree-builds')
+        build = builderstatus.BuildStatus(builder, 1)
+        build.setResults(builderstatus.SUCCESS)
+        ftb.requests[0].finished(build)
+        self.failIf(self.scheduler.gatedBranches)
+        self.failIf(self.scheduler.pendingChanges)
+        self.failUnlessEqual(sorted(pendings.keys()),
+                             [('other', 'de'), ('test', 'fr')])
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_k_gatedTrees(self):
+        # tree builds on two branches, the trees that one updates
+        # don't get compared when the other finishes
+        self.setupSimple()
+        t = scheduler.Tree('other', 'http://localhost/', 'other-branch',
+                           'l10n-other', 'other-app/locales/l10n.ini')
+        t.addData('other-branch', 'other-app/locales/l10n.ini',
+                  ['other-app'])
+        t.locales += ['de']
+        self.scheduler.addTree(t)
+        changes = []
+        for n, (branch, app) in enumerate((('test-branch', 'test-app'),
+                                           ('other-branch', 'other-app'))):
+            c = Change('author', [app + '/locales/l10n.ini'], 'comment',
+                       branch=branch)
+            c.number = n + 1
+            self.scheduler.addChange(c)
+            changes.append(c)
+        self.failUnlessEqual(len(self.master.sets), 2)
+        # both tree builds update their tree
+        for c, name, app in ((changes[0], 'test', 'test-app'),
+                             (changes[1], 'other', 'other-app')):
+            _t = scheduler.Tree.fromDict(
+                self.scheduler.trees[name].asDict())
+            _t.addData(c.branch, app + '/locales/l10n.ini', ['shared'])
+            self.scheduler.addTree(_t, changes=[c])
+        builders = []
+        for bset in self.master.sets:
+            ftb = FakeBuilder('tree-builds')
+            bset.start([ftb])
+            builders.append(ftb)
+        build = builderstatus.BuildStatus(
+            builderstatus.BuilderStatus('tree-builds'), 1)
+        build.setResults(builderstatus.SUCCESS)
+        builders[1].requests[0].finished(build)
+        pendings = self.scheduler.pendings
+        self.failUnlessEqual(pendings.keys(), [('other', 'de')])
+        self.failUnlessEqual(self.scheduler.priorities[('other', 'de')],
+                             'tree')
+        self.failUnlessEqual(self.scheduler.treesToDo.keys(), [changes[0]])
+        builders[0].requests[0].finished(build)
+        self.failIf(self.scheduler.treesToDo)
+        self.failUnlessEqual(sorted(pendings.keys()),
+                             [('other', 'de'), ('test', 'de'),
+                              ('test', 'fr')])
+        self.failUnlessEqual(pendings[('test', 'de')], [changes[0]])
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_l_state(self):
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        inipath = os.path.join(basedir, 'l10nbuilds.ini')
+        with open(inipath, 'w') as f:
+            f.write('[test]\n')
+        statefile = os.path.join(basedir, 'state.json')
+        s = scheduler.AppScheduler('test-sched', ['compare'], inipath,
+                                   'tree-builds', statefile=statefile)
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['test-app'], tld='test')
+        t.all_locales = 'test-app/locales/all-locales'
+        t.locales += ['de', 'fr']
+        s.trees['test'] = t
+        s.trees['removed'] = scheduler.Tree(
+            'removed', 'http://localhost/', 'test-branch', 'l10n-test',
+            'removed/locales/l10n.ini')
+        s.saveState()
+        self.addScheduler('test-sched', ['compare'], inipath, 'tree-builds',
+                          statefile=statefile)
+        self.failUnlessEqual(self.scheduler.trees.keys(), ['test'])
+        loaded = self.scheduler.trees['test']
+        self.failUnlessEqual(loaded, t)
+        self.failUnlessEqual(loaded.tld, 'test')
+        self.failUnless(isinstance(loaded.l10ninis.keys()[0], str))
+        # the trees get refreshed, but changes don't wait for that
+        self.failUnlessEqual(len(self.master.sets), 1)
+        self.failUnless(self.scheduler.waitOnTree is None)
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'de'})
+        c.number = 1
+        self.scheduler.addChange(c)
+        self.failUnlessEqual(self.scheduler.pendings.keys(),
+                             [('test', 'de')])
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_m_badState(self):
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        inipath = os.path.join(basedir, 'l10nbuilds.ini')
+        with open(inipath, 'w') as f:
+            f.write('[test]\n')
+        statefile = os.path.join(basedir, 'state.json')
+        with open(statefile, 'w') as f:
+            f.write('{"version": 0, "trees": []}')
+        self.addScheduler('test-sched', ['compare'], inipath, 'tree-builds',
+                          statefile=statefile)
+        self.failIf(self.scheduler.trees)
+        self.failIf(self.scheduler.waitOnTree is None)
+
+    def finishBuildset(self, bset, number=1):
+        ftb = FakeBuilder('compare')
+        bset.start([ftb])
+        builder = builderstatus.BuilderStatus('compare')
+        build = builderstatus.BuildStatus(builder, number)
+        build.setResults(builderstatus.SUCCESS)
+        ftb.requests[0].finished(build)
+
+    def test_n_maxPending(self):
+        self.setupSimple(maxPending=1)
+        self.createPushes(['de', 'fr'])
+        c = Change('author', ['test-app/locales/en-US/file.dtd'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        self.scheduler.addChange(c)
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'fr'})
+        c.number = 2
+        self.scheduler.addChange(c)
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        # the locale push goes first, de is held back
+        self.failUnlessEqual(len(self.master.sets), 1)
+        self.failUnlessEqual(self.master.sets[0].properties['locale'], 'fr')
+        self.failUnlessEqual(self.scheduler.pendings.keys(), [('test', 'de')])
+        self.failUnlessEqual(self.scheduler.outstanding, 1)
+        # more changes get merged into the pending build
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'de'})
+        c.number = 3
+        self.scheduler.addChange(c)
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        self.failUnlessEqual(len(self.master.sets), 1)
+        self.failUnlessEqual(len(self.scheduler.pendings[('test', 'de')]), 2)
+        # finishing the build frees the slot
+        self.finishBuildset(self.master.sets[0])
+        self.failUnlessEqual(self.scheduler.outstanding, 0)
+        self.failUnless(self.scheduler.dSubmitBuildsets)
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        self.failUnlessEqual(len(self.master.sets), 2)
+        self.failUnlessEqual(self.master.sets[1].properties['locale'], 'de')
+        self.failIf(self.scheduler.pendings)
+
+    def test_n_cancelled(self):
+        self.setupSimple(maxPending=1)
+        self.createPushes(['de', 'fr'])
+        self.master.builder = builder = QueueBuilder('compare')
+        self.scheduler.compareBuild('test', 'de', [])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        self.failUnlessEqual(self.scheduler.outstanding, 1)
+        # cancelled in the web status, the buildset never finishes
+        builder.cancelBuildRequest(builder.requests[0])
+        self.scheduler.compareBuild('test', 'fr', [])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        self.failUnlessEqual(len(self.master.sets), 2)
+        self.failUnlessEqual(self.master.sets[1].properties['locale'], 'fr')
+        self.failUnlessEqual(self.scheduler.outstanding, 1)
+        self.failUnlessEqual(self.scheduler.inflight.keys(), [('test', 'fr')])
+
+    def createPush(self, name):
+        from life.models import Branch, Changeset, Push, Repository
+        default, _ = Branch.objects.get_or_create(name='default')
+        repo = Repository.objects.get(name=name)
+        cs = Changeset.objects.create(
+            revision=hashlib.sha1(
+                name + str(Changeset.objects.count())).hexdigest(),
+            branch=default)
+        repo.changesets.add(cs)
+        push = Push.objects.create(repository=repo, user='jane',
+                                   push_date=datetime.utcnow(),
+                                   push_id=Push.objects.count() + 1)
+        push.changesets.add(cs)
+        tips.cache.update(name, push.id, push.push_date, str(cs.revision))
+        return push
+
+    def test_n_starting(self):
+        self.setupSimple(maxPending=1)
+        self.createPushes(['de', 'fr'])
+        self.master.builder = builder = QueueBuilder('compare')
+        self.scheduler.compareBuild('test', 'de', [])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        # the builder picked the request, and pings the slave
+        builder.pickBuild(builder.requests[0])
+        self.scheduler.compareBuild('test', 'fr', [])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        # the starting build keeps its slot
+        self.failUnlessEqual(len(self.master.sets), 1)
+        self.failUnlessEqual(self.scheduler.outstanding, 1)
+        self.failUnlessEqual(self.scheduler.inflight.keys(), [('test', 'de')])
+
+    def pushTo(self, name):
+        self.createPush(name)
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', when=time.time() + 1)
+        self.scheduler.compareBuild('test', 'de', [c])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+
+    def test_o_supersede(self):
+        self.setupSimple()
+        self.createPushes(['de'])
+        self.master.builder = builder = QueueBuilder('compare')
+        self.pushTo('l10n-test/de')
+        self.failUnlessEqual(len(builder.requests), 1)
+        first = builder.requests[0]
+        # a newer revision cancels the queued request
+        self.pushTo('l10n-test/de')
+        self.failUnlessEqual(len(builder.requests), 1)
+        self.failIf(builder.requests[0] is first)
+        self.failUnlessEqual(self.scheduler.outstanding, 1)
+        self.failUnlessEqual(len(self.scheduler.inflight[('test', 'de')]), 1)
+        # and takes over its changes
+        changes = builder.requests[0].source.changes
+        self.failUnlessEqual(len(changes), 2)
+        self.failUnless(changes[0] is first.source.changes[0])
+        # a newer revision stops the running build
+        build = builder.startBuild(builder.requests[0])
+        self.pushTo('l10n-test/de')
+        self.failUnless(build.stopped)
+        self.failUnless('superseded' in build.properties)
+        self.failUnlessEqual(self.scheduler.outstanding, 2)
+        self.failUnlessEqual(len(builder.requests[0].source.changes), 3)
+        # same revisions don't supersede
+        builder.startBuild(builder.requests[0])
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', when=time.time() + 1)
+        self.scheduler.compareBuild('test', 'de', [c])
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.submitBuildsets()
+        self.failUnlessEqual(len(builder.requests), 1)
+        self.failUnlessEqual(self.scheduler.outstanding, 3)
+
+    def test_o_supersedeSetup(self):
+        self.setupSimple()
+        self.createPushes(['de'])
+        self.master.builder = builder = QueueBuilder('compare')
+        self.pushTo('l10n-test/de')
+        build = builder.startBuild(builder.requests[0])
+        # the build waits for its locks, and has no step to interrupt
+        build.currentStep = None
+        self.pushTo('l10n-test/de')
+        self.failIf(build.stopped)
+        # it still compares its changes, the newer build doesn't
+        self.failUnlessEqual(len(builder.requests[0].source.changes), 1)
+
+    def test_o_supersedeTie(self):
+        srctime = datetime(2020, 1, 1)
+        old = scheduler.InflightBuildset(None, srctime, {'l10n': 'a'}, 1)
+        # same revisions, or same srctime and older push
+        self.failIf(old.supersededBy(
+            scheduler.InflightBuildset(None, srctime, {'l10n': 'a'}, 2)))
+        self.failIf(old.supersededBy(
+            scheduler.InflightBuildset(None, srctime, {'l10n': 'b'}, 1)))
+        self.failIf(old.supersededBy(
+            scheduler.InflightBuildset(None, srctime, {'l10n': 'b'})))
+        # a newer push within the same second
+        self.failUnless(old.supersededBy(
+            scheduler.InflightBuildset(None, srctime, {'l10n': 'b'}, 2)))
+        self.failUnless(old.supersededBy(
+            scheduler.InflightBuildset(None, datetime(2020, 1, 2),
+                                       {'l10n': 'b'}, 1)))
+
+    def writeBuildsIni(self, inipath, sections, mtime):
+        with open(inipath, 'w') as f:
+            for name, locales in sections:
+                f.write('[%s]\nlocales = %s\n' % (name, locales))
+        os.utime(inipath, (mtime, mtime))
+
+    def appTree(self, name, dirs):
+        t = scheduler.Tree(name, 'http://localhost/', 'test-branch',
+                           'l10n-test', name + '/locales/l10n.ini')
+        t.addData('test-branch', name + '/locales/l10n.ini', dirs)
+        t.locales += ['de']
+        return t
+
+    def test_p_reload(self):
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        inipath = os.path.join(basedir, 'l10nbuilds.ini')
+        now = time.time()
+        self.writeBuildsIni(inipath, [('fx', 'de'), ('tb', 'de'),
+                                      ('sm', 'de')], now - 10)
+        self.addScheduler('test-sched', ['compare'], inipath, 'tree-builds')
+        for name in ('fx', 'tb', 'sm'):
+            self.scheduler.addTree(self.appTree(name, [name]))
+        for bset in self.master.sets:
+            self.finishBuildset(bset)
+        self.failIf(self.scheduler.pendings)
+        del self.master.sets[:]
+        # an unchanged file doesn't build trees
+        self.scheduler.checkBuildsIni()
+        self.failIf(self.master.sets)
+        # change tb, remove sm, add mb
+        self.writeBuildsIni(inipath, [('fx', 'de'), ('tb', 'de fr'),
+                                      ('mb', 'de')], now)
+        self.scheduler.checkBuildsIni()
+        self.failUnlessEqual(sorted(bset.getProperties()['tree']
+                                    for bset in self.master.sets),
+                             ['mb', 'tb'])
+        self.failUnlessEqual(sorted(self.scheduler.trees),
+                             ['fx', 'tb'])
+        self.failUnless('sm' not in self.scheduler.l10nbranches['l10n-test'])
+        self.failUnless('fx' in self.scheduler.l10nbranches['l10n-test'])
+        self.failUnless(self.scheduler.isGated(
+            Change('author', ['fx/file.dtd'], 'comment',
+                   branch='test-branch')))
+        self.scheduler.addTree(self.appTree('tb', ['tb', 'shared']))
+        self.scheduler.addTree(self.appTree('mb', ['mb']))
+        for bset in self.master.sets:
+            self.finishBuildset(bset)
+        self.failIf(self.scheduler.gatedBranches)
+        self.failUnlessEqual(sorted(self.scheduler.pendings),
+                             [('mb', 'de'), ('tb', 'de')])
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_q_interests(self):
+        self.setupSimple()
+        self.failUnlessEqual(self.scheduler.getInterests(),
+                             (set(['test-branch']), set(['l10n-test'])))
+        # while trees get built, we need all changes
+        c = Change('author', ['test-app/locales/l10n.ini'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        self.scheduler.addChange(c)
+        self.failUnless(self.scheduler.getInterests() is None)
+        self.finishBuildset(self.master.sets[0])
+        self.failUnlessEqual(self.scheduler.getInterests(),
+                             (set(['test-branch']), set(['l10n-test'])))
+
+
+class L10nDirs(unittest.TestCase):
+    segments = ['a', 'ab', 'b', 'browser', 'mobile', 'm']
+
+    def randomPath(self, rnd, depth):
+        return '/'.join(rnd.choice(self.segments)
+                        for _ in xrange(rnd.randint(1, depth)))
+
+    def test_startswith(self):
+        '''Check treesForFile against matching each dir with startswith.
+        '''
+        rnd = random.Random(42)
+        for _ in xrange(100):
+            l10ndirs = scheduler.AppScheduler.L10nDirs()
+            expected = defaultdict(set)
+            for _ in xrange(20):
+                tree = 'tree%d' % rnd.randint(0, 4)
+                dirs = [self.randomPath(rnd, 3)
+                        for _ in xrange(rnd.randint(0, 3))]
+                if rnd.random() < .7:
+                    l10ndirs.addDirs(tree, dirs)
+                    for d in dirs:
+                        expected[d].add(tree)
+                else:
+                    l10ndirs.removeDirs(tree, dirs)
+                    for d in dirs:
+                        expected[d].discard(tree)
+                        if not expected[d]:
+                            del expected[d]
+                self.failUnlessEqual(dict(l10ndirs), dict(expected))
+                for _ in xrange(10):
+                    path = self.randomPath(rnd, 4) + '/file.dtd'
+                    trees = set()
+                    for mod, _trees in expected.iteritems():
+                        if path.startswith(mod):
+                            trees |= _trees
+                    self.failUnlessEqual(l10ndirs.treesForFile(path), trees)
+
+    def test_prune(self):
+        l10ndirs = scheduler.AppScheduler.L10nDirs()
+        l10ndirs.addDirs('tree', ['browser', 'b'])
+        l10ndirs.removeDirs('tree', ['browser'])
+        self.failUnlessEqual(l10ndirs.trie, {'b': {None: 'b'}})
+        l10ndirs.removeDirs('tree', ['b'])
+        self.failUnlessEqual(l10ndirs.trie, {})
+
+
+class TipCache(unittest.TestCase):
+    def test_update(self):
+        cache = tips.TipCache()
+        cache.update('repo', 2, None, 'abc')
+        cache.update('repo', 1, None, 'old')
+        self.failUnlessEqual(cache.get('repo'), (2, None, 'abc'))
+        cache.update('repo', 3, None, 'new')
+        self.failUnlessEqual(cache.get('repo'), (3, None, 'new'))
+        cache.invalidate('repo')
+        self.failUnlessEqual(cache.get('repo'), None)
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from buildbot.process.properties import Properties
+from buildbot.status.builder import SUCCESS, FAILURE
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import os
+
+from l10ninsp import steps
+
+
+class FakeBuild:
+    def __init__(self):
+        self.properties = Properties()
+
+    def getProperties(self):
+        return self.properties
+
+    def setProperty(self, name, value, source):
+        self.properties.setProperty(name, value, source)
+
+    def allChanges(self):
+        return []
+
+
+class FakeStatus:
+    def setText(self, text):
+        pass
+
+    def setText2(self, text):
+        pass
+
+
+class FakeLog:
+    def __init__(self):
+        self.stdout = []
+        self.stderr = []
+
+    def addStdout(self, text):
+        self.stdout.append(text)
+
+    def addStderr(self, text):
+        self.stderr.append(text)
+
+
+class TreeLoader(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.makedirs(basedir)
+        self.inipath = os.path.join(basedir, 'l10nbuilds.ini')
+        with open(self.inipath, 'w') as f:
+            f.write('''[test]
+repo = http://localhost
+mozilla = central
+l10n.ini = app/locales/l10n.ini
+l10n = l10n-central
+locales = de fr
+''')
+        # deferreds per path, fired by the tests in any order
+        self.pages = {}
+        self.patch(steps.localrepos.files, 'getFile', self.getFile)
+        self.trees = []
+        self.results = []
+        self.log = FakeLog()
+
+    def getFile(self, repo, branch, rev, path, **kwargs):
+        d = self.pages[path] = defer.Deferred()
+        return d
+
+    def addTree(self, tree, changes=None):
+        self.trees.append(tree)
+
+    def startStep(self, **kwargs):
+        step = steps.TreeLoader('test', self.inipath, cb=self.addTree,
+                                **kwargs)
+        step.build = FakeBuild()
+        step.step_status = FakeStatus()
+        step.addLog = step.getLog = lambda name: self.log
+        step.finished = self.results.append
+        step.start()
+        return step
+
+    def loadMain(self):
+        self.pages.pop('app/locales/l10n.ini').callback('''[compare]
+dirs = app
+
+[includes]
+toolkit = toolkit/locales/l10n.ini
+other = other/locales/l10n.ini
+''')
+
+    def test_outOfOrder(self):
+        step = self.startStep(maxFetches=2)
+        self.failUnlessEqual(self.pages.keys(), ['app/locales/l10n.ini'])
+        self.loadMain()
+        self.failUnlessEqual(sorted(self.pages),
+                             ['other/locales/l10n.ini',
+                              'toolkit/locales/l10n.ini'])
+        # the second include responds first
+        self.pages.pop('other/locales/l10n.ini').callback(
+            '[compare]\ndirs = other\n')
+        self.failIf(self.results)
+        self.failUnlessEqual(step.pending, 1)
+        self.pages.pop('toolkit/locales/l10n.ini').callback(
+            '[compare]\ndirs = toolkit\n')
+        self.failUnlessEqual(self.results, [SUCCESS])
+        self.failUnlessEqual(len(self.trees), 1)
+        tree = self.trees[0]
+        # the data is in the order of the includes
+        self.failUnlessEqual(tree.branch2dirs,
+                             {'central': ['app', 'toolkit', 'other']})
+        self.failUnlessEqual(tree.l10ninis,
+                             {'central': ['app/locales/l10n.ini',
+                                          'toolkit/locales/l10n.ini',
+                                          'other/locales/l10n.ini']})
+        self.failUnlessEqual(tree.locales, ['de', 'fr'])
+
+    def test_maxFetches(self):
+        self.startStep(maxFetches=1)
+        self.loadMain()
+        # the second include waits for the first
+        self.failUnlessEqual(self.pages.keys(), ['toolkit/locales/l10n.ini'])
+        self.pages.pop('toolkit/locales/l10n.ini').callback(
+            '[compare]\ndirs = toolkit\n')
+        self.failUnlessEqual(self.pages.keys(), ['other/locales/l10n.ini'])
+        self.pages.pop('other/locales/l10n.ini').callback(
+            '[compare]\ndirs = other\n')
+        self.failUnlessEqual(self.results, [SUCCESS])
+
+    def test_failedInclude(self):
+        self.startStep()
+        self.loadMain()
+        self.pages.pop('toolkit/locales/l10n.ini').errback(
+            Exception('not found'))
+        self.failIf(self.results)
+        self.pages.pop('other/locales/l10n.ini').callback(
+            '[compare]\ndirs = other\n')
+        self.failUnlessEqual(self.results, [FAILURE])
+        self.failIf(self.trees)
+        self.failUnless('not found' in ''.join(self.log.stderr))
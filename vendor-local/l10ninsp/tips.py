@@ -0,0 +1,39 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''In-process cache of the latest push on the 'default' branch
+per repository.
+
+The push change source updates this as it submits pushes, and the
+scheduler reads from it, to not ask the database for data we just saw.
+'''
+
+
+class TipCache(object):
+    def __init__(self):
+        # repository name -> (push id, push date, revision)
+        self.tips = {}
+
+    def get(self, name):
+        return self.tips.get(name)
+
+    def update(self, name, push_id, push_date, revision):
+        '''Record a push with a tip on the 'default' branch.
+
+        Older pushes than the one we know about are ignored, so that
+        replays don't move the cache back in time.
+        '''
+        tip = self.tips.get(name)
+        if tip is not None and tip[0] >= push_id:
+            return
+        self.tips[name] = (push_id, push_date, revision)
+
+    def invalidate(self, name):
+        self.tips.pop(name, None)
+
+    def clear(self):
+        self.tips.clear()
+
+
+cache = TipCache()